@@ -0,0 +1,316 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from os import path
+
+from data import profiling
+
+parser = argparse.ArgumentParser(
+    description="Time the data/data.py functions and the full comparison "
+                "path on synthetic movie data at several scales")
+parser.add_argument("--scales", type=int, nargs='+',
+                    help="Multiples of --movies to run at",
+                    default=[1, 10, 100])
+parser.add_argument("--movies", type=int,
+                    help="Number of movies at scale 1",
+                    default=10000)
+parser.add_argument("--cast-mean", type=float,
+                    help="Average number of cast members of a movie",
+                    default=8.0)
+parser.add_argument("--genre-mean", type=float,
+                    help="Average number of genres of a movie",
+                    default=1.8)
+parser.add_argument("--genres", type=int,
+                    help="Number of genres",
+                    default=300)
+parser.add_argument("--category", "-c", type=str, nargs='+',
+                    help="Properties to run the category benchmarks on",
+                    choices=['genre', 'cast_member', 'director'],
+                    default=['genre', 'cast_member'])
+parser.add_argument("--score", "-s", type=str,
+                    help="Score of the benchmarks",
+                    choices=['return', 'critic_percent', 'critic_average',
+                             'audience_percent', 'audience_average'],
+                    default='critic_percent')
+parser.add_argument("--min-movies", "-m", type=int,
+                    help="Minimum number of movies of each person/genre "
+                         "compared",
+                    default=10)
+parser.add_argument("--influencers", "-i", type=int,
+                    help="Number of influential people/genres compared",
+                    default=25)
+parser.add_argument("--repeat", type=int,
+                    help="Run each benchmark this many times and keep the "
+                         "fastest",
+                    default=1)
+parser.add_argument("--no-memory", action='store_true',
+                    help="Don't trace the peak memory (tracing slows the "
+                         "benchmarks down)")
+parser.add_argument("--seed", type=int,
+                    help="Seed of the synthetic data",
+                    default=0)
+parser.add_argument("--directory", type=str,
+                    help="Folder to generate the data in, kept between runs "
+                         "(default: a temporary folder)",
+                    default=None)
+parser.add_argument("--output", "-o", type=str,
+                    help="Append the results of the run to this JSON lines "
+                         "file",
+                    default=None)
+parser.add_argument("--baseline", type=str,
+                    help="JSON lines file of earlier runs: fail if a benchmark "
+                         "got slower or uses more memory than in the last one",
+                    default=None)
+parser.add_argument("--tolerance", type=float,
+                    help="Allowed slowdown or memory growth before failing, "
+                         "as a fraction of the baseline",
+                    default=0.25)
+
+# benchmarks shorter than this are too noisy to compare their times
+MIN_COMPARED_SECONDS = 0.05
+
+
+def measure(name, repeat, memory, rows, function, *args):
+    """
+    Run a benchmark as a profiling stage
+    :param name: String, name of the benchmark
+    :param repeat: int, number of runs, the fastest is kept
+    :param memory: bool, trace the peak memory
+    :param rows: int, rows processed (default: those of the first
+    dataframe argument)
+    :param function: function benchmarked
+    :return: tuple, (result of the function, record of the fastest run with
+    the records of the stages inside it)
+    """
+    best = None
+    for _ in range(repeat):
+        profiling.enable(memory)
+        try:
+            result = profiling.stage(name)(function)(*args)
+        finally:
+            profiling.disable()
+        records = profiling.collect()
+        record = records.pop()
+        record['stages'] = records
+        if best is None or record['seconds'] < best['seconds']:
+            best = record
+    best['rows'] = rows if rows is not None else best['rows_in']
+    best['rows_per_second'] = (best['rows'] / best['seconds']
+                               if best['rows'] and best['seconds'] else None)
+    return result, best
+
+
+def tukey(data, category, score):
+    """
+    The statistics of comparison.py on get_movie_data's output
+    :return: dict, as returned by significance.tukey_hsd
+    """
+    import significance
+
+    stats = significance.group_stats(data[score].values,
+                                     data[category].values)
+    significance.anova(stats)
+    return significance.tukey_hsd(stats, pairs=False)
+
+
+def benchmark_cache(scale):
+    """
+    :param scale: int, multiple of args.movies
+    :return: String, folder of the columnar cache entries of a scale
+    """
+    from data import columnar
+
+    return path.join(columnar.CACHE_PATH, 'benchmark', '{}x'.format(scale))
+
+
+def run_scale(scale, args, directory):
+    """
+    Generate the data of a scale and run every benchmark on it
+    :param scale: int, multiple of args.movies
+    :param args: Namespace, command line arguments
+    :param directory: String, folder to generate the data in
+    :return: List of dict, one record per benchmark
+    """
+    import data.data as dm
+    from data import columnar, synthetic
+
+    movies = args.movies * scale
+    folder = path.join(directory, '{}x'.format(scale))
+    json_path = path.join(folder, '{}.json.gz')
+    # the synthetic tables get their own columnar cache entries
+    prefix = path.join('benchmark', '{}x'.format(scale), '')
+    memory = not args.no_memory
+    results = []
+
+    def record(benchmark, category, timing):
+        timing.update(scale=scale, movies=movies, benchmark=benchmark,
+                      category=category)
+        print("{:>4}x {:<22} {:<12} {:9.3f}s {:>12,.0f} rows/s".format(
+            scale, benchmark, category or '', timing['seconds'],
+            timing['rows_per_second'] or 0))
+        results.append(timing)
+
+    generated = path.join(folder, 'generated.json')
+    parameters = {'movies': movies, 'cast_mean': args.cast_mean,
+                  'genre_mean': args.genre_mean, 'genres': args.genres,
+                  'seed': args.seed}
+    if path.isfile(generated):
+        with open(generated) as f:
+            if json.load(f) == parameters:
+                parameters = None
+    if parameters:
+        if not path.isdir(folder):
+            os.makedirs(folder)
+        print("Generating {:,} movies in {}".format(movies, folder))
+        start = time.perf_counter()
+        synthetic.generate(folder, **parameters)
+        print("Generated in {:.1f}s".format(time.perf_counter() - start))
+        with open(generated, 'w') as f:
+            json.dump(parameters, f)
+
+    def read_cold():
+        columnar.remove_columnar(prefix + 'wikidata-movies')
+        return dm.MovieSession(json_path, False, prefix).table(
+            'wikidata-movies')
+
+    def read_warm():
+        return dm.MovieSession(json_path, False, prefix).table(
+            'wikidata-movies')
+
+    _, timing = measure('read_json_gz', args.repeat, memory, movies,
+                        read_cold)
+    record('read_json_gz', None, timing)
+    table, timing = measure('json_to_df', args.repeat, memory, movies,
+                            read_warm)
+    record('json_to_df', None, timing)
+
+    session = dm.MovieSession(json_path, False, prefix)
+    scores = session.rt_scores(args.score) if args.score != 'return' else None
+    # codes of the synthetic ids, built before timing the coding
+    session.id_dictionary()
+    if scores is not None:
+        _, timing = measure('merge_rt_data', args.repeat, memory, None,
+                            dm.merge_rt_data, table, args.score, scores)
+        record('merge_rt_data', None, timing)
+
+    for category in args.category:
+        prepped, timing = measure('prep_wikidata', args.repeat, memory, None,
+                                  dm.prep_wikidata, table, category,
+                                  args.score, None, scores, session)
+        record('prep_wikidata', category, timing)
+        _, timing = measure('explode', args.repeat, memory, None,
+                            dm.explode_dataframe_by_column, prepped,
+                            category, dm.ID_DTYPE)
+        record('explode', category, timing)
+        _, timing = measure('avg_by_category', args.repeat, memory, None,
+                            dm.avg_by_category, prepped, category, args.score)
+        record('avg_by_category', category, timing)
+        _, timing = measure('build_category_index', args.repeat, memory,
+                            None, dm.build_category_index, prepped, category,
+                            args.score, session)
+        record('build_category_index', category, timing)
+
+        def pipeline():
+            # a new session: the tables come from the columnar cache
+            data = dm.MovieSession(json_path, False, prefix).filtered_movies(
+                category, args.score, args.min_movies, args.influencers)
+            return data, tukey(data, category, args.score)
+
+        (data, _), timing = measure('get_movie_data_tukey', args.repeat,
+                                    memory, movies, pipeline)
+        record('get_movie_data_tukey', category, timing)
+        _, timing = measure('tukey_hsd', args.repeat, memory, None, tukey,
+                            data, category, args.score)
+        record('tukey_hsd', category, timing)
+    return results
+
+
+def last_run(file):
+    """
+    :param file: String, JSON lines file of runs
+    :return: dict, the last run recorded
+    """
+    with open(file) as f:
+        lines = [line for line in f if line.strip()]
+    return json.loads(lines[-1])
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Benchmarks slower or using more memory than in the baseline
+    :param results: List of dict, records of this run
+    :param baseline: List of dict, records of the baseline run
+    :param tolerance: float, allowed growth as a fraction of the baseline
+    :return: List of String, description of each regression
+    """
+    def key(result):
+        return result['scale'], result['benchmark'], result['category']
+
+    before = {key(result): result for result in baseline}
+    found = []
+    for result in results:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        name = '{}x {} {}'.format(*key(result))
+        if (old['seconds'] >= MIN_COMPARED_SECONDS and
+                result['seconds'] > old['seconds'] * (1 + tolerance)):
+            found.append('{}: {:.3f}s, was {:.3f}s'.format(
+                name, result['seconds'], old['seconds']))
+        if (old.get('peak_bytes') and result.get('peak_bytes') and
+                result['peak_bytes'] > old['peak_bytes'] * (1 + tolerance)):
+            found.append('{}: peak {:,} bytes, was {:,}'.format(
+                name, result['peak_bytes'], old['peak_bytes']))
+    return found
+
+
+def main(args=None):
+    if args is None:
+        args = parser.parse_args()
+    import numpy as np
+    import pandas as pd
+    import significance
+
+    # load scipy.stats before timing anything
+    significance.studentized_range()
+
+    directory = args.directory or tempfile.mkdtemp(prefix='movie-benchmark-')
+    results = []
+    try:
+        for scale in args.scales:
+            results += run_scale(scale, args, directory)
+    finally:
+        if not args.directory:
+            shutil.rmtree(directory)
+            # the columnar cache entries of the temporary data
+            for scale in args.scales:
+                shutil.rmtree(benchmark_cache(scale), ignore_errors=True)
+
+    run = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(),
+           'numpy': np.__version__,
+           'pandas': pd.__version__,
+           'args': {k: v for k, v in vars(args).items()
+                    if k not in ('output', 'baseline', 'directory')},
+           'results': results}
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(run) + '\n')
+
+    if args.baseline:
+        found = regressions(results, last_run(args.baseline)['results'],
+                            args.tolerance)
+        for regression in found:
+            print("REGRESSION " + regression)
+        if found:
+            sys.exit(1)
+    print("Benchmark Done")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,9 @@
-from scipy import stats
-from statsmodels.stats.multicomp import pairwise_tukeyhsd
-import data.data as dm
 import argparse
-import seaborn
-import matplotlib.pyplot as plt
+
+from data import profiling
+
+# numpy, the data, the statistics and matplotlib are imported by the stages
+# that need them, so --help and --no-plot don't pay for them
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--category", "-c", type=str,
@@ -23,75 +23,239 @@ parser.add_argument("--year", "-y", type=int, nargs='+',
                     help="Bound the publication dates by the years",
                     default=None)
 
-args = parser.parse_args()
+parser.add_argument("--no-cache", action='store_true',
+                    help="Don't read or write the cached movie data")
+parser.add_argument("--refresh", action='store_true',
+                    help="Rebuild the cached movie data")
+parser.add_argument("--exact", action='store_true',
+                    help="Find the most influential from the full movie table "
+                         "instead of the aggregate index")
+parser.add_argument("--pairs", action='store_true',
+                    help="Print every pairwise comparison of Tukey's HSD")
+parser.add_argument("--no-pvalues", action='store_true',
+                    help="Leave the adjusted p values out of --pairs (they "
+                         "are most of its time with hundreds of groups)")
+parser.add_argument("--resample", "-r", type=int,
+                    help="Use a permutation test and bootstrap intervals with "
+                         "this many resamples instead of the ANOVA and Tukey's "
+                         "HSD",
+                    default=0)
+parser.add_argument("--seed", type=int,
+                    help="Seed of the resampling",
+                    default=0)
+parser.add_argument("--jobs", "-j", type=int,
+                    help="Number of processes to resample in",
+                    default=1)
+parser.add_argument("--no-plot", action='store_true',
+                    help="Only print the statistics (without loading "
+                         "matplotlib)")
+parser.add_argument("--csv", type=str,
+                    help="Save the mean and interval of each person/genre in "
+                         "this CSV file",
+                    default=None)
+parser.add_argument("--timings", type=str,
+                    help="Save the wall time, rows in/out and peak memory of "
+                         "each stage in this JSON file ('-' to print them)",
+                    default=None)
+parser.add_argument("--profile", type=str,
+                    help="Save a cProfile dump of the run in this file "
+                         "(pyinstrument's report if it ends with .html)",
+                    default=None)
 
-filename = '{}-{}-{}-{}'.format(args.category, args.score, args.movies,
-                                args.influencers)
+ALPHA = 0.05
 
-if args.year:
-    filename += "-{}-{}".format(args.year[0], args.year[1])
 
-ALPHA = 0.05
+def get_filename(args):
+    """
+    Name of the figure, made of the parameters used
+    :param args: Namespace, command line arguments
+    :return: String, file name
+    """
+    filename = '{}-{}-{}-{}'.format(args.category, args.score, args.movies,
+                                    args.influencers)
+    if args.year:
+        filename += "-{}-{}".format(args.year[0], args.year[1])
+    if getattr(args, 'resample', 0):
+        filename += "-bootstrap"
+    return filename
 
 
-def main():
+def plot_simultaneous(group_stats, halfwidths, ax, figsize=(10, 6),
+                      xlabel=None, ylabel=None,
+                      title="Multiple Comparisons Between All Pairs (Tukey)"):
+    """
+    Plot the simultaneous confidence interval of each group mean, like the
+    plot_simultaneous of statsmodels' Tukey HSD results
+    :param group_stats: Dataframe, from significance.group_stats
+    :param halfwidths: array, half width of each interval, or the distances
+    to the lower and upper bounds (2 rows) for uneven intervals
+    :param ax: Axes, where to plot
+    :param figsize: tuple, size of the figure
+    :param xlabel: String, label of the x axis
+    :param ylabel: String, label of the y axis
+    :param title: String, title of the plot
+    :return: Figure
+    """
+    import numpy as np
+
+    fig = ax.figure
+    fig.set_size_inches(figsize)
+    means = group_stats['mean'].values
+    ax.errorbar(means, np.arange(len(means)), xerr=halfwidths, marker='o',
+                linestyle='None', color='k', ecolor='k')
+    ax.set_title(title)
+    halfwidths = np.atleast_2d(halfwidths)
+    minrange = means - halfwidths[0]
+    maxrange = means + halfwidths[-1]
+    r = maxrange.max() - minrange.min()
+    ax.set_ylim([-1, len(means)])
+    ax.set_xlim([minrange.min() - r / 10.0, maxrange.max() + r / 10.0])
+    ax.set_yticks(np.arange(-1, len(means) + 1))
+    ax.set_yticklabels([''] + group_stats.index.astype(str).tolist() + [''])
+    ax.set_xlabel(xlabel if xlabel is not None else '')
+    ax.set_ylabel(ylabel if ylabel is not None else '')
+    return fig
+
+
+@profiling.stage('plot_comparison')
+def plot_comparison(group_stats, errors, plot_title, args, filename):
+    """
+    Save the plot of the interval of each person/genre mean to figures/
+    :param group_stats: Dataframe, from significance.group_stats
+    :param errors: array, half widths of the intervals (see
+    plot_simultaneous)
+    :param plot_title: String, name of the intervals
+    :param args: Namespace, command line arguments
+    :param filename: String, name of the figure
+    """
+    import matplotlib.pyplot as plt
+    import seaborn
+
     seaborn.set()
-    data = dm.get_movie_data(filename, args)
+    title_score = args.score.title().replace("_", " ")
+    if args.score == "return":
+        xlabel = "Percent Return (box office/cost)"
+    else:
+        xlabel = "Rotten Tomatoes' {}".format(
+            title_score)
+    ylabel = args.category.title().replace("_", " ") + 's'
+
+    title = "{}' {} Comparison".format(
+        ylabel, title_score
+    )
+    if args.year:
+        title += " from {} to {}".format(args.year[0], args.year[1])
+
+    ax = plt.axes()
+    plt.subplots_adjust(left=.20)
+    ax.yaxis.label.set_size(20)
+    ax.xaxis.label.set_size(20)
+    for tick in ax.yaxis.get_major_ticks():
+        tick.label1.set_fontsize(16)
+        tick.label1.set_rotation(30)
 
+    for tick in ax.xaxis.get_major_ticks():
+        tick.label1.set_fontsize(14)
+
+    fig = plot_simultaneous(
+        group_stats, errors,
+        title=plot_title,
+        xlabel=xlabel,
+        ylabel=ylabel,
+        ax=ax,
+        figsize=(16, 8),
+        )
+    fig.suptitle(title)
+    fig.savefig("figures/" + filename)
+    plt.close(fig)
+
+
+def compare(data, args, filename):
+    """
+    Run the ANOVA on the movie data and, if the means differ, save the Tukey
+    HSD plot to figures/. With args.resample, the ANOVA's p value comes from a
+    permutation test and the plot shows bootstrap intervals instead
+    :param data: Dataframe, movie data from get_movie_data
+    :param args: Namespace, command line arguments
+    :param filename: String, name of the figure
+    :return: float, p value of the ANOVA (None if there are less than two
+    groups to compare)
+    """
+    import numpy as np
+    import significance
+
+    group_stats = significance.group_stats(data[args.score].values,
+                                           data[args.category].values)
+    if len(group_stats) < 2:
+        print("No {}s with at least {} movies".format(
+            args.category.replace("_", " "), args.movies))
+        return None
+
+    resamples = getattr(args, 'resample', 0)
+    resampling = dict(resamples=resamples, seed=getattr(args, 'seed', 0),
+                      jobs=getattr(args, 'jobs', 1))
     print("DEGUG: TukeyHSD")
-    data_pivoted = data.pivot(columns=args.category)[args.score]
-    new_data = [data_pivoted[col].dropna() for col in data_pivoted]
-    anova = stats.f_oneway(*new_data)
-    print("P Value from f_oneway of the {} {}s is {}".format(
+    if resamples:
+        anova = significance.permutation_anova(
+            data[args.score].values, data[args.category].values, **resampling)
+        test = "a permutation test"
+    else:
+        anova = significance.anova(group_stats)
+        test = "f_oneway"
+    print("P Value from {} of the {} {}s is {}".format(
+        test,
         args.influencers,
         args.category.replace("_", " "),
         anova.pvalue))
 
+    table = group_stats[['n', 'mean']].copy()
     if anova.pvalue <= ALPHA:
-        print("There is a difference between means, proceed to Tukey's HSD")
-        posthoc = pairwise_tukeyhsd(
-            data[args.score], data[args.category],
-            alpha=ALPHA)
-
-        print(data.groupby(args.category).agg({
-            args.score: 'mean'}).sort_values(args.score, ascending=False))
-
-        title_score = args.score.title().replace("_", " ")
-        if args.score == "return":
-            xlabel = "Percent Return (box office/cost)"
+        if resamples:
+            print("There is a difference between means, bootstrap the means")
+            intervals = significance.bootstrap_ci(
+                data[args.score].values, data[args.category].values,
+                alpha=ALPHA, **resampling)
+            errors = np.vstack([intervals['mean'] - intervals['lower'],
+                                intervals['upper'] - intervals['mean']])
+            plot_title = "Bootstrap {:.0%} Confidence Intervals".format(
+                1 - ALPHA)
         else:
-            xlabel = "Rotten Tomatoes' {}".format(
-                title_score)
-        ylabel = args.category.title().replace("_", " ") + 's'
+            print("There is a difference between means, proceed to Tukey's HSD")
+            pairs = getattr(args, 'pairs', False)
+            pvalues = not getattr(args, 'no_pvalues', False)
+            posthoc = significance.tukey_hsd(group_stats, alpha=ALPHA,
+                                             pairs=pairs, pvalues=pvalues)
+            if pairs:
+                print(posthoc['pairs'].to_string(index=False))
+            errors = posthoc['halfwidths']
+            plot_title = "Multiple Comparisons Between All Pairs (Tukey)"
+        bounds = np.atleast_2d(errors)
+        table['lower'] = table['mean'] - bounds[0]
+        table['upper'] = table['mean'] + bounds[-1]
 
-        title = "{}' {} Comparison".format(
-            ylabel, title_score
-        )
-        if args.year:
-            title += " from {} to {}".format(args.year[0], args.year[1])
-
-        ax = plt.axes()
-        plt.subplots_adjust(left=.20)
-        ax.yaxis.label.set_size(20)
-        ax.xaxis.label.set_size(20)
-        for tick in ax.yaxis.get_major_ticks():
-            tick.label.set_fontsize(16)
-            tick.label.set_rotation(30)
-
-        for tick in ax.xaxis.get_major_ticks():
-            tick.label.set_fontsize(14)
-
-        fig = posthoc.plot_simultaneous(
-            xlabel=xlabel,
-            ylabel=ylabel,
-            ax=ax,
-            figsize=(16, 8),
-            )
-        fig.suptitle(title)
-        fig.savefig("figures/" + filename)
+        print(group_stats[['mean']].rename(columns={'mean': args.score})
+              .sort_values(args.score, ascending=False))
+        if not getattr(args, 'no_plot', False):
+            plot_comparison(group_stats, errors, plot_title, args, filename)
     else:
         print("Can't confirm there is a difference between means")
 
+    if getattr(args, 'csv', None):
+        table.index.name = args.category
+        table.to_csv(args.csv)
+    return anova.pvalue
+
+
+def main(args=None):
+    if args is None:
+        args = parser.parse_args()
+    import data.data as dm
+
+    def run():
+        data = dm.get_movie_data(args)
+        compare(data, args, get_filename(args))
+
+    profiling.run(run, args.timings, args.profile, vars(args))
     print("Done!")
 
 
@@ -2,6 +2,9 @@
 Mostly written by ggbaker
 """
 import sys
+import glob
+import os
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession, functions, types
 
 spark = SparkSession.builder \
@@ -9,38 +12,56 @@ spark = SparkSession.builder \
     .getOrCreate()
 
 assert sys.version_info >= (3, 5) # make sure we have Python 3.5+
-assert spark.version >= '2.1' # make sure we have Spark 2.1+
+assert spark.version >= '2.4' # make sure we have Spark 2.4+ (for transform/array_min)
 
-import datetime
-ISOFMT = '+%Y-%m-%dT%H:%M:%SZ'
+# columns of the movie table that hold wikidata ids, made into label maps by
+# the 'all' mode: lists of ids, then single ids (see take_first)
+LIST_CATEGORIES = ['genre', 'main_subject', 'filming_location', 'director',
+                   'cast_member', 'executive_producer']
+SINGLE_CATEGORIES = ['series', 'based_on', 'country_of_origin',
+                     'original_language']
+
+
+def strict_date(s):
+    """
+    SQL for the date in the yyyy-mm-dd string s, or NULL if there is no such
+    day. Casting alone isn't enough: older Sparks roll invalid days over into
+    the next month.
+    """
+    return "IF(CAST(CAST({0} AS DATE) AS STRING) = {0}, CAST({0} AS DATE), NULL)".format(s)
 
 
 def extract_isodate(d):
     """
-    Handle the slightly crazy date format from wikidata.
+    Handle the slightly crazy date format from wikidata (eg '+2001-05-00T00:00:00Z'), as SQL on the string d.
+
+    Days == '00' (or otherwise invalid) become the 1st of the month, then months == '00' become January, as the
+    strptime version of this did. Dates that aren't '+yyyy-...' (BCE, >9999) are NULL.
     """
-    try:
-        return datetime.datetime.strptime(d, ISOFMT).date()
-    except ValueError:
-        try:
-            # days == '00' aren't acceptable. Adapt.
-            d0 = d[:9] + '01' + d[11:]
-            return datetime.datetime.strptime(d0, ISOFMT).date()
-        except ValueError:
-            # ... same for month == '00'
-            d1 = d0[:6] + '01' + d0[8:]
-            return datetime.datetime.strptime(d1, ISOFMT).date()
+    day = "substr({}, 2, 10)".format(d)
+    month = "concat(substr({}, 2, 8), '01')".format(d)
+    year = "concat(substr({}, 2, 5), '01-01')".format(d)
+    return "IF({0} RLIKE '^\\\\+[0-9]{{4}}-', coalesce({1}, {2}, {3}), NULL)".format(
+        d, strict_date(day), strict_date(month), strict_date(year))
 
 
-@functions.udf(returnType=types.DateType())
 def first_publication_date(pds):
     """
     Get the earliest publication date, deciphering the wikidata date format along the way.
+
+    Built-in functions only (no Python UDF), so the rows never leave the JVM.
+    """
+    return functions.expr('array_min(transform({}, d -> {}))'.format(pds, extract_isodate('d')))
+
+
+def read_wikidata(location):
+    """
+    Read the output of transform_download.py: its parquet version, or the
+    by-line JSON written by its local (no Spark) mode
     """
-    if pds is None:
-        return None
-    dates = map(extract_isodate, pds)
-    return min(dates)
+    if glob.glob(os.path.join(location, 'part-*.gz')):
+        return spark.read.json(location)
+    return spark.read.parquet(location)
 
 
 def take_first(wd, col):
@@ -50,22 +71,51 @@ def take_first(wd, col):
     return wd[col].getItem(0).alias(col)
 
 
-def make_label_map():
+def get_label_map(wd):
     """
-    Create a full list of wikidata_id values to human-readable labels.
+    Every wikidata_id value with its human-readable label.
+    """
+    return wd.filter(wd['label'].isNotNull()).select(wd['id'].alias('wikidata_id'), wd['label'])
 
-    Off by default: creates about 1GB json.gz output.
 
-    Could probably trim the output significantly by taking only values that appear in the wikidata_movies output.
+def movie_ids(movies):
     """
-    wd = spark.read.parquet(sys.argv[1])
-    label_map = wd.filter(wd['label'].isNotNull()).select(wd['id'].alias('wikidata_id'), wd['label'])
-    label_map.repartition(10).write.json('./label_map', mode='overwrite', compression='gzip')
+    The distinct wikidata_id values the movie table refers to, in any of the
+    category columns (the only ones that need a label).
+    """
+    ids = [movies.select(functions.explode(movies[c]).alias('wikidata_id'))
+           for c in LIST_CATEGORIES]
+    ids += [movies.select(movies[c].alias('wikidata_id'))
+            for c in SINGLE_CATEGORIES]
+    all_ids = ids[0]
+    for i in ids[1:]:
+        all_ids = all_ids.union(i)
+    return all_ids.where(all_ids['wikidata_id'].isNotNull()).distinct()
+
+
+def make_label_map(wd=None, movies=None, cache=False):
+    """
+    Create a full list of wikidata_id values to human-readable labels.
 
+    Off by default: creates about 1GB json.gz output. Given the movie table, only the values that appear in it are kept
+    (a few MB), which is what the 'all' mode does.
+    With cache, the label map is cached before it is written, so later uses don't compute it again.
+    """
+    if wd is None:
+        wd = read_wikidata(sys.argv[1])
+    label_map = get_label_map(wd)
+    if movies is not None:
+        label_map = label_map.join(functions.broadcast(movie_ids(movies)), on='wikidata_id')
+    if cache:
+        label_map = label_map.cache()
+    label_map.repartition(10).write.json('./label_map', mode='overwrite', compression='gzip')
+    return label_map
 
-def make_wikidata_movies():
-    wd = spark.read.parquet(sys.argv[1])
 
+def wikidata_movies(wd):
+    """
+    The movie table: movies with enough data, with the fields we want to keep.
+    """
     # just movies
     wd = wd.where(wd['imdb_id'].isNotNull()).where(functions.substring(wd['imdb_id'].getItem(0), 0, 2) == 'tt')
 
@@ -105,7 +155,7 @@ def make_wikidata_movies():
         #wd['composer'],
         #take_first(wd, 'production_company'),
         #take_first(wd, 'distributor'),
-        first_publication_date(wd['publication_date']).alias('publication_date'),
+        first_publication_date('publication_date').alias('publication_date'),
         take_first(wd, 'based_on'),
         take_first(wd, 'country_of_origin'),
         take_first(wd, 'original_language'),
@@ -116,15 +166,28 @@ def make_wikidata_movies():
         wd['ncost'],
         (wd['nbox']/wd['ncost']).alias('return')
     )
+    return output_data
+
+
+def make_wikidata_movies(wd=None, cache=False):
+    """
+    Write the movie table. With cache, it is cached before it is written, so later uses don't compute it again.
+    """
+    if wd is None:
+        wd = read_wikidata(sys.argv[1])
+    output_data = wikidata_movies(wd)
+    if cache:
+        output_data = output_data.cache()
     # output is about 4MB compressed: safe to .coalesce().
     output_data.coalesce(1).write.json('./wikidata-movies', mode='overwrite', compression='gzip')
+    return output_data
 
 
 def make_genre_map():
     """
     Make mapping of genre wikidata_id value to numan-readable label.
     """
-    wd = spark.read.parquet(sys.argv[1])
+    wd = read_wikidata(sys.argv[1])
     label_map = wd.filter(wd.label.isNotNull()).select(wd['id'].alias('wikidata_id'), wd['label'])
     genres = wd.select(functions.explode(wd['genre']).alias('wikidata_id')).distinct()
     genres = functions.broadcast(genres) # only a few thousand values that we want to keep
@@ -134,21 +197,29 @@ def make_genre_map():
     genres.coalesce(1).write.json('./genres', mode='overwrite', compression='gzip')
 
 
-def make_custom_map(category):
+def make_custom_map(category, wd=None, label_map=None):
     """
     Written by Tyler Pham
     Make mapping of of a category wikidata_id value to human-readable label.
     Output directory is the same name of the category
     Adapted from 'make_genre_map'
     :param category: string, name of the category from transform_download.py
+    :param wd: Dataframe, data to take the category from (default: read the
+    wikidata location). The movie table in the 'all' mode
+    :param label_map: Dataframe, wikidata_id and label (default: built from
+    wd)
     :return:
     """
-
-    wd = spark.read.parquet(sys.argv[1])
-    label_map = wd.filter(
-        wd.label.isNotNull()).select(wd['id'].alias('wikidata_id'), wd['label'])
-    data = wd.select(
-        functions.explode(wd[category]).alias('wikidata_id')).distinct()
+    if wd is None:
+        wd = read_wikidata(sys.argv[1])
+    if label_map is None:
+        label_map = get_label_map(wd)
+    if isinstance(wd.schema[category].dataType, types.ArrayType):
+        data = wd.select(
+            functions.explode(wd[category]).alias('wikidata_id'))
+    else:
+        data = wd.select(wd[category].alias('wikidata_id'))
+    data = data.where(data['wikidata_id'].isNotNull()).distinct()
     data = functions.broadcast(data)
     data = data.join(label_map, on='wikidata_id')
     data = data.withColumnRenamed('label', category)
@@ -157,9 +228,28 @@ def make_custom_map(category):
                                 compression='gzip')
 
 
+def make_all():
+    """
+    Build the movie table, the label maps of every category it refers to and
+    its (trimmed) full label map in one job: the wikidata location is read
+    once, and the labels are only joined for the ids of the movie table.
+    """
+    wd = read_wikidata(sys.argv[1])
+    wd.persist(StorageLevel.MEMORY_AND_DISK)
+    # cached before they are written: the writes fill the caches, and the
+    # category maps then never go back to the wikidata
+    movies = make_wikidata_movies(wd, cache=True)
+    label_map = make_label_map(wd, movies, cache=True)
+    for category in LIST_CATEGORIES + SINGLE_CATEGORIES:
+        make_custom_map(category, movies, label_map)
+    wd.unpersist()
+
+
 if __name__ == "__main__":
     category = sys.argv[2]
-    if category == 'movies':
+    if category == 'all':
+        make_all()
+    elif category == 'movies':
         make_wikidata_movies()
     elif category == 'genres':
         make_genre_map()
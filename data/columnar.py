@@ -0,0 +1,349 @@
+"""
+Columnar on-disk cache for the json.gz files in data/json.
+
+Every dataframe is written as one uncompressed .npz file with one or more
+arrays per column plus a small .json file describing the columns and the
+source file the data came from:
+    numeric/date columns -> the numpy array as is
+    string columns       -> int32 codes into a table of unique values
+    list columns         -> offsets into one flat (string encoded) values array
+    anything else        -> pickled object array
+Unique strings are stored as a single utf-8 buffer separated by NUL, so
+loading them back is a single decode and split instead of a JSON parse.
+"""
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from itertools import chain
+from os import path
+
+import numpy as np
+import pandas as pd
+
+CACHE_PATH = path.join(path.dirname(path.abspath(__file__)), 'cache')
+FORMAT_VERSION = 1
+SEPARATOR = '\0'
+
+
+def flatten_list_column(series, dtype=object):
+    """
+    Split a column of lists into the length of every list and one flat array
+    of all the values, in order. Missing values count as empty lists
+    :param series: Series, column of lists
+    :param dtype: type of the values array (eg np.int32 for coded ids)
+    :return: tuple, (array of list lengths, array of the values)
+    """
+    notnull = pd.notnull(series).values
+    lists = series.values[notnull]
+    lengths = np.zeros(len(series), dtype=np.int64)
+    lengths[notnull] = [len(l) for l in lists]
+    if np.dtype(dtype) == object:
+        values = np.empty(lengths.sum(), dtype=object)
+        values[:] = list(chain.from_iterable(lists))
+    else:
+        values = np.fromiter(chain.from_iterable(lists), dtype=dtype,
+                             count=lengths.sum())
+    return lengths, values
+
+
+def group_into_lists(values, lengths):
+    """
+    Inverse of flatten_list_column: cut the flat values back into one list
+    per row. Rows with no values become NaN
+    :param values: array, flat values
+    :param lengths: array, number of values of each row
+    :return: List, one list (or NaN) per row
+    """
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = values.tolist()
+    offsets = offsets.tolist()
+    return [values[start:end] if end > start else np.nan
+            for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def file_fingerprint(file, with_hash=True):
+    """
+    Identify the contents of a file by its modification time, size and
+    (optionally) sha1 digest
+    :param file: String, path of the file
+    :param with_hash: bool, compute the sha1 of the contents
+    :return: dict, fingerprint of the file
+    """
+    stat = os.stat(file)
+    fingerprint = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+    if with_hash:
+        sha1 = hashlib.sha1()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        fingerprint['sha1'] = sha1.hexdigest()
+    return fingerprint
+
+
+def _paths(name):
+    base = path.join(CACHE_PATH, name)
+    return base + '.npz', base + '.json'
+
+
+def _read_meta(name):
+    meta_file = _paths(name)[1]
+    try:
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if meta.get('version') != FORMAT_VERSION:
+        return None
+    return meta
+
+
+def temporary_name(file):
+    """
+    Name to write 'file' under before moving it into place. Unique to the
+    process, so several processes can fill the cache at once
+    :param file: String, path of the final file
+    :return: String, path of the temporary file
+    """
+    return '{}.{}.tmp'.format(file, os.getpid())
+
+
+def _write_json(meta, file):
+    tmp = temporary_name(file)
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, file)
+
+
+def is_fresh(name, source, reader_version=None):
+    """
+    Check the cached copy of 'name' was built from the current 'source' file.
+    The modification time and size are checked first, the sha1 is only
+    computed when those changed (eg after a fresh checkout)
+    :param name: String, name of the cache entry
+    :param source: String, path of the file the entry was built from
+    :param reader_version: version of the code that parsed the source, if it
+    has to match too
+    :return: bool, True if the cache can be used
+    """
+    meta = _read_meta(name)
+    if meta is None or not path.isfile(_paths(name)[0]):
+        return False
+    if (reader_version is not None and
+            meta.get('reader_version') != reader_version):
+        return False
+    cached = meta.get('source')
+    if cached is None:
+        return True
+    current = file_fingerprint(source, with_hash=False)
+    if (current['mtime_ns'] == cached['mtime_ns'] and
+            current['size'] == cached['size']):
+        return True
+    if current['size'] != cached['size']:
+        return False
+    current = file_fingerprint(source)
+    if current['sha1'] != cached['sha1']:
+        return False
+    # same contents, only the timestamp changed: remember the new one
+    meta['source'] = current
+    _write_json(meta, _paths(name)[1])
+    return True
+
+
+def source_digest(name, source):
+    """
+    sha1 of a source file, reusing the one recorded by the cache entry built
+    from it when that entry is still fresh
+    :param name: String, name of the cache entry
+    :param source: String, path of the source file
+    :return: String, hex digest
+    """
+    if is_fresh(name, source):
+        return _read_meta(name)['source']['sha1']
+    return file_fingerprint(source)['sha1']
+
+
+def _encode_strings(values):
+    codes, uniques = pd.factorize(values)
+    blob = SEPARATOR.join(uniques).encode('utf-8')
+    return (codes.astype(np.int32),
+            np.frombuffer(blob, dtype=np.uint8),
+            len(uniques))
+
+
+def _decode_strings(codes, blob, count):
+    if count:
+        uniques = blob.tobytes().decode('utf-8').split(SEPARATOR)
+    else:
+        uniques = []
+    # the missing value sits at the end, so a code of -1 maps to NaN
+    table = np.empty(count + 1, dtype=object)
+    table[:count] = uniques
+    table[count] = np.nan
+    return table.take(codes)
+
+
+def _all_strings(values):
+    return all(isinstance(v, str) for v in values)
+
+
+def _column_kind(series):
+    if series.dtype.kind in 'biufcmM':
+        return 'array'
+    values = np.asarray(series, dtype=object)
+    nonnull = values[pd.notnull(values)]
+    if _all_strings(nonnull):
+        return 'string'
+    if all(isinstance(v, list) for v in nonnull):
+        if _all_strings(chain.from_iterable(nonnull)):
+            return 'list'
+    return 'object'
+
+
+def _encode_column(series, kind):
+    if kind == 'array':
+        return {'': series.values}
+    values = np.asarray(series, dtype=object)
+    if kind == 'string':
+        codes, blob, count = _encode_strings(values)
+        return {'codes': codes, 'uniques': blob, 'count': np.array(count)}
+    if kind == 'list':
+        lengths, flat = flatten_list_column(series)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        codes, blob, count = _encode_strings(flat)
+        return {'offsets': offsets, 'nulls': pd.isnull(values),
+                'codes': codes, 'uniques': blob, 'count': np.array(count)}
+    return {'': values}
+
+
+def _decode_column(arrays, key, kind):
+    def get(part):
+        return arrays[key + part]
+
+    if kind == 'array':
+        return get('')
+    if kind == 'string':
+        return _decode_strings(get('.codes'), get('.uniques'),
+                               int(get('.count')))
+    if kind == 'list':
+        flat = _decode_strings(get('.codes'), get('.uniques'),
+                               int(get('.count')))
+        flat = flat.tolist()
+        offsets = get('.offsets').tolist()
+        return [np.nan if null else flat[start:end]
+                for start, end, null in zip(offsets[:-1], offsets[1:],
+                                            get('.nulls').tolist())]
+    return get('')
+
+
+def save_columnar(df, name, source=None, reader_version=None):
+    """
+    Save a dataframe to the columnar cache
+    :param df: Dataframe, data to be saved
+    :param name: String, name of the cache entry
+    :param source: String, path of the file the data was built from. Used to
+    invalidate the entry when that file changes
+    :param reader_version: version of the code that parsed the source
+    """
+    data_file, meta_file = _paths(name)
+    os.makedirs(path.dirname(data_file), exist_ok=True)
+    arrays = {}
+    columns = []
+    for i, column in enumerate(df.columns):
+        kind = _column_kind(df[column])
+        for part, array in _encode_column(df[column], kind).items():
+            arrays[str(i) + ('.' + part if part else '')] = array
+        columns.append({'name': column, 'kind': kind})
+
+    meta = {'version': FORMAT_VERSION, 'rows': len(df), 'columns': columns}
+    if source is not None:
+        meta['source'] = file_fingerprint(source)
+        meta['reader_version'] = reader_version
+
+    # never leave a description of the old data next to the new data
+    _remove(meta_file)
+    tmp = temporary_name(data_file)
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, data_file)
+    _write_json(meta, meta_file)
+
+
+def load_columnar(name, columns=None):
+    """
+    Load a dataframe from the columnar cache. Only the requested columns are
+    read from disk
+    :param name: String, name of the cache entry
+    :param columns: List, columns to load (default all)
+    :return: Dataframe, or None if there is no entry (or it was removed while
+    it was being read)
+    """
+    meta = _read_meta(name)
+    data_file = _paths(name)[0]
+    if meta is None or not path.isfile(data_file):
+        return None
+
+    data = OrderedDict()
+    try:
+        with np.load(data_file, allow_pickle=True) as arrays:
+            for i, column in enumerate(meta['columns']):
+                if columns is not None and column['name'] not in columns:
+                    continue
+                data[column['name']] = _decode_column(arrays, str(i),
+                                                      column['kind'])
+    except (IOError, KeyError):
+        # removed or replaced by another process since the meta was read
+        return None
+    names = [c['name'] for c in meta['columns'] if c['name'] in data]
+    return pd.DataFrame(data, columns=names,
+                        index=pd.RangeIndex(meta['rows']))
+
+
+def columnar_size(name):
+    """
+    :param name: String, name of the cache entry
+    :return: int, bytes used on disk by the entry (0 if there is none)
+    """
+    return sum(path.getsize(f) for f in _paths(name) if path.isfile(f))
+
+
+def _remove(file):
+    # another process may be removing or replacing it at the same time
+    try:
+        os.remove(file)
+    except FileNotFoundError:
+        pass
+
+
+def remove_columnar(name):
+    """
+    Delete a cache entry
+    :param name: String, name of the cache entry
+    """
+    for f in reversed(_paths(name)):
+        _remove(f)
+
+
+def cached_read(name, source, reader, columns=None, reader_version=0):
+    """
+    Read 'source' through the columnar cache: the first time (or whenever the
+    source or reader_version changes) it is parsed with 'reader' and saved,
+    afterwards the cached copy is loaded instead
+    :param name: String, name of the cache entry
+    :param source: String, path of the file to read
+    :param reader: function, parses the source file into a dataframe
+    :param columns: List, columns to return (default all)
+    :param reader_version: int, change it when 'reader' changes its output
+    :return: Dataframe
+    """
+    if is_fresh(name, source, reader_version):
+        data = load_columnar(name, columns)
+        if data is not None:
+            return data
+    data = reader(source)
+    save_columnar(data, name, source, reader_version)
+    if columns is not None:
+        data = data[[c for c in data.columns if c in columns]]
+    return data
@@ -2,23 +2,52 @@ import sys
 import pandas as pd
 import numpy as np
 import gzip
+from collections import OrderedDict
 from os import path
-from datetime import datetime
+from data import columnar, profiling, result_cache
 
 JSON_PATH = path.dirname(__file__) + '/json/{}.json.gz'
+NO_YEAR = -1
+# change when read_json_gz changes what it adds to the loaded files
+READER_VERSION = 1
+CATEGORIES = ['genre', 'cast_member', 'director']
+ID_DTYPE = np.int32
+# query results a session keeps in memory, the least recently used go first
+MAX_SESSION_RESULTS = 32
+# averages are ranked on this many decimals, so the same average summed in a
+# different order (full table or aggregate index) is still a tie
+RANK_DECIMALS = 9
 
+_sessions = {}
 
-def json_to_df(file):
+
+def read_json_gz(file):
     """
-    opens the gzip file into a pd dataframe
-    :param file: string, name of the file
+    parses a gzip file of json lines into a pd dataframe. Files with a
+    'publication_date' also get integer 'year' and 'decade' columns
+    :param file: string, path of the file
     :return: dataframe of the json file
     """
-    data = pd.read_json(gzip.open(path.abspath(JSON_PATH.format(file)), 'rt',
-                                  encoding='utf-8'), lines=True)
+    data = pd.read_json(gzip.open(file, 'rt', encoding='utf-8'), lines=True)
+    if 'publication_date' in data:
+        data['year'] = parse_years(data['publication_date'])
+        data['decade'] = bin_years(data['year'].values)
     return data
 
 
+@profiling.stage('json_to_df')
+def json_to_df(file, columns=None):
+    """
+    opens the gzip file into a pd dataframe. The file is only parsed the first
+    time (or after it changes), later calls load the columnar cache
+    :param file: string, name of the file
+    :param columns: list, columns to load (default all)
+    :return: dataframe of the json file
+    """
+    return columnar.cached_read(file, path.abspath(JSON_PATH.format(file)),
+                                read_json_gz, columns, READER_VERSION)
+
+
 def df_to_json(df, file):
     """
     saves pd dataframe as gzip file
@@ -31,22 +60,75 @@ def df_to_json(df, file):
                compression='gzip')
 
 
-def prep_wikidata(wikidata_df, category, rating, year):
+def load_id_dictionary(session=None):
+    """
+    Every wikidata id gets a small integer code: its position in this index
+    (see MovieSession.id_dictionary)
+    :param session: MovieSession, owner of the codes (default: the default
+    session)
+    :return: Index, wikidata ids in order of their code
+    """
+    return (session or default_session()).id_dictionary()
+
+
+def encode_ids(ids, session=None):
+    """
+    Convert wikidata ids to their integer codes
+    :param ids: array, wikidata ids
+    :param session: MovieSession, owner of the codes
+    :return: array of ID_DTYPE codes
+    """
+    return (session or default_session()).encode_ids(ids)
+
+
+def decode_ids(codes, session=None):
+    """
+    Convert integer codes back to wikidata ids
+    :param codes: array, codes from encode_ids
+    :param session: MovieSession, owner of the codes
+    :return: array of wikidata ids
+    """
+    return load_id_dictionary(session).values.take(np.asarray(codes))
+
+
+def encode_id_lists(series, session=None):
+    """
+    Convert a column of lists of wikidata ids to lists of integer codes
+    :param series: Series, lists of wikidata ids
+    :param session: MovieSession, owner of the codes
+    :return: Series, lists of codes (NaN where there was no list)
+    """
+    lengths, values = columnar.flatten_list_column(series)
+    codes = encode_ids(values, session)
+    return pd.Series(columnar.group_into_lists(codes, lengths),
+                     index=series.index, dtype=object)
+
+
+@profiling.stage('prep_wikidata')
+def prep_wikidata(wikidata_df, category, rating, year, scores=None,
+                  session=None):
     """
     Remove extra columns of the wikidata dataframe and only keep a specific
     category ('cast_member', 'director', 'genre'), 'label', 'publication_date',
-    'return' (nbox/ncost), and 'wikidata_id'. Remove any NaN in category
+    'year', 'decade', 'return' (nbox/ncost), and 'wikidata_id'. Remove any NaN
+    in category and convert its ids to integer codes
     :param wikidata_df: Dataframe, wikidata dataframe
     :param category: String, column of interest
     :param rating: String, type of rating to focus
+    :param year: List, start (inclusive) and end (exclusive) year
+    :param scores: Series, rotten tomatoes scores (default: those of the
+    session)
+    :param session: MovieSession, owner of the codes and scores (default:
+    the default session)
     :return: dataframe with extra columns removed
     """
-    columns = [category, 'label', 'publication_date', 'wikidata_id',
-               'rotten_tomatoes_id']
+    columns = [category, 'label', 'publication_date', 'year', 'decade',
+               'wikidata_id', 'rotten_tomatoes_id']
     if rating == 'return':
         columns += ['return']
     wikidata_df = wikidata_df[columns]
     wikidata_df = wikidata_df.dropna(subset=[category])
+    wikidata_df[category] = encode_id_lists(wikidata_df[category], session)
 
 
     if rating == 'return':
@@ -54,19 +136,50 @@ def prep_wikidata(wikidata_df, category, rating, year):
     # audience_average, audience_percent, audience_ratings, critic_average,
     # critic_percent
     else:
-        wikidata_df = merge_rt_data(wikidata_df, rating)
+        if scores is None and session is not None:
+            scores = session.rt_scores(rating)
+        wikidata_df = merge_rt_data(wikidata_df, rating, scores)
+
+    return filter_years(wikidata_df, year)
+
 
+def filter_years(wikidata_df, year):
+    """
+    Keep the movies published within the years
+    :param wikidata_df: Dataframe, wikidata with a 'year' column
+    :param year: List, start (inclusive) and end (exclusive) year, or None to
+    keep everything
+    :return: Dataframe
+    """
     if year:
-        wikidata_df = wikidata_df[pd.notnull(wikidata_df['publication_date'])]
-        wikidata_df['year'] = wikidata_df['publication_date'].apply(get_year)
-        wikidata_df = wikidata_df .loc[(wikidata_df['year'] >= year[0]) &
-                                       (wikidata_df['year'] < year[1])]
+        # movies without a date have NO_YEAR, which is outside any bound
+        wikidata_df = wikidata_df.loc[(wikidata_df['year'] >= year[0]) &
+                                      (wikidata_df['year'] < year[1])]
     return wikidata_df
 
 
-def get_year(date):
-    year = datetime.strptime(date, '%Y-%m-%d').year
-    return year
+def parse_years(dates):
+    """
+    Get the year of many publication dates at once. Full ('1995-01-01') and
+    partial ('1995', '1995-01') dates are accepted, missing or malformed ones
+    get NO_YEAR
+    :param dates: Series, publication dates
+    :return: array of int years
+    """
+    years = dates.astype(object).str.extract(r'^\s*(\d{4})(?:-\d\d?){0,2}\b',
+                                             expand=False)
+    years = pd.to_numeric(years, errors='coerce')
+    return years.fillna(NO_YEAR).values.astype(np.int32)
+
+
+def bin_years(years, width=10):
+    """
+    Round years down to the start of their bin (10 for decades)
+    :param years: array, int years
+    :param width: int, number of years in a bin
+    :return: array of the first year of each bin, NO_YEAR stays NO_YEAR
+    """
+    return np.where(years == NO_YEAR, NO_YEAR, years // width * width)
 
 
 def clean_return_data(data):
@@ -83,67 +196,88 @@ def clean_return_data(data):
                             ascending=False)
 
 
-def merge_rt_data(wikidata_df, rating):
+def load_rt_scores(rating):
+    """
+    One rotten tomatoes score indexed by rotten_tomatoes_id, from the default
+    session (see MovieSession.rt_scores)
+    :param rating: String, type of rating to focus
+    :return: Series, score of each movie
+    """
+    return default_session().rt_scores(rating)
+
+
+@profiling.stage('merge_rt_data')
+def merge_rt_data(wikidata_df, rating, scores=None):
     """
-    Combine wikidata with rotten tomatoes data to get specific rating
+    Combine wikidata with rotten tomatoes data to get specific rating. Movies
+    without the rating are dropped, like an inner merge
     :param wikidata_df: Dataframe, wikidata dataframe
     :param rating: String, type of rating to focus
+    :param scores: Series, as returned by load_rt_scores (default: those of
+    the default session)
     :return: dataframe, wikidata and rotten tomatoes data merged
     """
-    rt_df = json_to_df('rotten-tomatoes')
-    rt_df = rt_df[['rotten_tomatoes_id', rating]]
-    rt_df = rt_df.dropna(subset=[rating])
-    wikidata_df = pd.merge(wikidata_df, rt_df, on='rotten_tomatoes_id')
+    if scores is None:
+        scores = load_rt_scores(rating)
+    positions = scores.index.get_indexer(wikidata_df['rotten_tomatoes_id'])
+    found = positions >= 0
+    wikidata_df = wikidata_df[found].reset_index(drop=True)
+    wikidata_df[rating] = scores.values[positions[found]]
     return wikidata_df
 
 
-def map_wikidata_id(data, category):
+def label_ids(ids, category, session=None):
     """
-    Map the wikidata id to the corresponding label
-    :param data: Dataframe, dataframe with wikidata_id to be mapped
-    :param category: String, column of interest
-    :return: Dataframe with column mapped
+    Look up the labels of many wikidata ids at once
+    :param ids: array, wikidata ids (or their integer codes)
+    :param category: String, name of the label map
+    :param session: MovieSession, owner of the codes and label maps
+    (default: the default session)
+    :return: array of labels, NaN where the id has no label
     """
-    category_df = json_to_df(category)
-    mapping = category_df.set_index('wikidata_id').T.to_dict('records')[0]
-    data[category] = data[category].map(mapping)
-    return data
+    session = session or default_session()
+    ids = np.asarray(ids)
+    if ids.dtype.kind in 'iu':
+        ids = decode_ids(ids, session)
+    index, table = session.labels(category)
+    # unknown ids are -1, which picks the NaN at the end of the table
+    return table.take(index.get_indexer(ids))
 
 
-def split_list_into_rows(row, row_accumulator, column):
+@profiling.stage('map_wikidata_id')
+def map_wikidata_id(data, category, session=None):
     """
-    adapted from https://gist.github.com/jlln/338b4b0b55bd6984f883
-    If a row in the dataframe has a list of values in 'column', split the row
-    into multiple rows
-    :param row: Series, row of dataframe to be split
-    :param row_accumulator: list, new rows to be made into dataframe
-    :param column: String, column of dataframe to split on
+    Map the wikidata id (or its integer code) to the corresponding label
+    :param data: Dataframe, dataframe with wikidata_id to be mapped
+    :param category: String, column of interest
+    :param session: MovieSession, owner of the codes and label maps
+    :return: Dataframe with column mapped
     """
-
-    split_row = row[column]
-    for s in split_row:
-        new_row = row.to_dict()
-        new_row[column] = s
-        row_accumulator.append(new_row)
+    data[category] = label_ids(data[category].values, category, session)
+    return data
 
 
-def explode_dataframe_by_column(data, column):
+@profiling.stage('explode')
+def explode_dataframe_by_column(data, column, dtype=object):
     """
     Adapted from https://gist.github.com/jlln/338b4b0b55bd6984f883
-    Creates a new dataframe with the list in 'column' split into multiple rows
+    Creates a new dataframe with the list in 'column' split into multiple rows.
+    Every other column is repeated by the length of the list, so no per row
+    objects are created
     :param data: Dataframe, wikidata
     :param column: String, column of interest
+    :param dtype: type of the values in the lists (ID_DTYPE for coded ids)
     :return: Dataframe with 'column' split
     """
-
-    new_rows = []
     data = data.dropna(subset=[column])
-    data.apply(split_list_into_rows, axis=1,
-               args=(new_rows, column))
-    new_df = pd.DataFrame(new_rows)
+    lengths, values = columnar.flatten_list_column(data[column], dtype)
+    positions = np.repeat(np.arange(len(data)), lengths)
+    new_df = data.iloc[positions].reset_index(drop=True)
+    new_df[column] = values
     return new_df
 
 
+@profiling.stage('avg_by_category')
 def avg_by_category(data, category, rating):
     """
     Keeps numerical values of interest around the 'category' and organizes the
@@ -153,7 +287,7 @@ def avg_by_category(data, category, rating):
     :param rating: String, type of rating to focus
     :return: Dataframe, organized by persons average scores and number of movies
     """
-    new_df = explode_dataframe_by_column(data, category)
+    new_df = explode_dataframe_by_column(data, category, ID_DTYPE)
     req_columns = [category, rating]
 
     grouped_df = new_df[req_columns].groupby(category)
@@ -164,7 +298,21 @@ def avg_by_category(data, category, rating):
     return merged_df
 
 
-def get_top(data, rating, min_num_of_movies, num_of_influencers):
+def rank_order(mean, ids=None):
+    """
+    Order of the best averages: descending, ties by ascending wikidata id
+    :param mean: array, average score of each person/genre
+    :param ids: array, wikidata id of each person/genre (default: ties keep
+    their order)
+    :return: array of positions, best first
+    """
+    key = -np.round(mean, RANK_DECIMALS)
+    if ids is None:
+        return np.argsort(key, kind='mergesort')
+    return np.lexsort((np.asarray(ids, dtype=str), key))
+
+
+def get_top(data, rating, min_num_of_movies, num_of_influencers, ids=None):
     """
     Remove any person/genre involved in less than (min num of movies) movies
     (arbitrary) and sort by the rating (return, rotten_tomatos scores).
@@ -173,10 +321,14 @@ def get_top(data, rating, min_num_of_movies, num_of_influencers):
     :param rating: String, type of rating to focus
     :param min_num_of_movies: int, filter out any with less than
     :param num_of_influencers: int, number of points to take
+    :param ids: array, wikidata id of each row, to break ties (see rank_order)
     :return: dataframe sorted by descending score,
     """
-    data = data.loc[(data['movies'] >= min_num_of_movies)]
-    data = data.sort_values(rating, ascending=False)
+    keep = (data['movies'] >= min_num_of_movies).values
+    data = data.loc[keep]
+    if ids is not None:
+        ids = np.asarray(ids)[keep]
+    data = data.iloc[rank_order(data[rating].values, ids)]
     data = data.head(num_of_influencers)
     return data
 
@@ -190,82 +342,592 @@ def get_best_rated(wikidata_df, category, rating,
     :param rating: String, type of rating to focus
     :param min_num_of_movies: int, filter out any with less than
     :param num_of_influencers: int, number of points to take
-    :return: list of best rated people/genres
+    :return: list of codes of the best rated people/genres
     """
     data = avg_by_category(wikidata_df, category, rating)
     best_rated = get_top(data, rating, min_num_of_movies, num_of_influencers)
     return best_rated[category].tolist()
 
 
-def filter_category(category, influencers):
+@profiling.stage('build_category_index')
+def build_category_index(wikidata_df, category, rating, session=None):
     """
-    Ignore values not in the list of influencers
-    :param category: List, influencing points in a category
-    :param influencers: List, most popular infleuncing points
-    :return: List, only popular influencers
+    Sum and count of the rating of every person/genre in each year, sorted by
+    person/genre then year. Movies without a publication date are kept under
+    the year NO_YEAR so they still count when no years are given
+    :param wikidata_df: Dataframe, wikidata prepared without a year bound
+    :param category: String, column of interest
+    :param rating: String, type of rating to focus
+    :param session: MovieSession, owner of the codes
+    :return: Dataframe, columns category (wikidata ids, since codes only hold
+    within a session), 'year', 'sum' and 'count'
+    """
+    data = wikidata_df[[category, rating, 'year']]
+    data = explode_dataframe_by_column(data, category, ID_DTYPE)
+    grouped = data.groupby([category, 'year'])[rating].agg(['sum', 'count'])
+    grouped = grouped.reset_index()
+    grouped[category] = decode_ids(grouped[category].values, session)
+    return grouped
+
+
+def prepare_category_index(index, category, session=None):
+    """
+    Turn an aggregate index into the arrays used by query_category_index:
+    prefix sums of the sums and counts, and a sorted (person/genre, year) key
+    :param index: Dataframe, as returned by build_category_index
+    :param category: String, column of interest
+    :param session: MovieSession, owner of the codes
+    :return: dict of arrays
+    """
+    codes, entities = pd.factorize(index[category])
+    years = index['year'].values.astype(np.int64)
+    first_year = years.min() if len(years) else 0
+    span = (years.max() - first_year + 1) if len(years) else 1
+    # rows are sorted by person/genre then year, so (code, year) as a single
+    # number is sorted too and a year range is found with a binary search
+    return {'entities': encode_ids(entities, session),
+            'ids': np.asarray(entities, dtype=str),
+            'keys': codes * span + (years - first_year),
+            'sums': np.concatenate([[0], np.cumsum(index['sum'].values)]),
+            'counts': np.concatenate([[0], np.cumsum(index['count'].values)]),
+            'first_year': first_year,
+            'span': span}
+
+
+@profiling.stage('rank_category_index')
+def rank_category_index(index, min_num_of_movies, num_of_influencers,
+                        year=None):
+    """
+    The best rated people/genres of an aggregate index: the sums and counts of
+    every person/genre inside the years come from prefix sums, then only the
+    best num_of_influencers (and those tied with the last of them) are sorted.
+    Ties are broken as in get_top
+    :param index: dict, as returned by MovieSession.category_index
+    :param min_num_of_movies: int, filter out any with less than
+    :param num_of_influencers: int, number of points to take
+    :param year: List, start (inclusive) and end (exclusive) year
+    :return: tuple of arrays, (codes, average score, number of movies) of the
+    best rated people/genres, best first
     """
-    new_list = list(set(influencers) & set(category))
-    if new_list:
-        return new_list
+    span = index['span']
+    if year:
+        start = np.clip(year[0] - index['first_year'], 0, span)
+        end = np.clip(year[1] - index['first_year'], 0, span)
+    else:
+        start, end = 0, span
+    entity_codes = np.arange(len(index['entities'])) * span
+    low = np.searchsorted(index['keys'], entity_codes + start)
+    high = np.searchsorted(index['keys'], entity_codes + end)
+
+    count = index['counts'][high] - index['counts'][low]
+    candidates = np.flatnonzero((count >= min_num_of_movies) & (count > 0))
+    mean = ((index['sums'][high] - index['sums'][low])[candidates] /
+            count[candidates])
+    if len(candidates) > num_of_influencers > 0:
+        key = -np.round(mean, RANK_DECIMALS)
+        last = np.partition(key, num_of_influencers - 1)[
+            num_of_influencers - 1]
+        best = np.flatnonzero(key <= last)
     else:
-        return np.nan
+        best = np.arange(len(candidates))
+    best = best[rank_order(mean[best], index['ids'][candidates[best]])]
+    best = best[:max(num_of_influencers, 0)]
+    return (index['entities'][candidates[best]], mean[best],
+            count[candidates[best]])
+
+
+def query_category_index(index, min_num_of_movies, num_of_influencers,
+                         year=None):
+    """
+    Same as get_best_rated, but answered from an aggregate index (see
+    rank_category_index)
+    :param index: dict, as returned by MovieSession.category_index
+    :param min_num_of_movies: int, filter out any with less than
+    :param num_of_influencers: int, number of points to take
+    :param year: List, start (inclusive) and end (exclusive) year
+    :return: list of codes of the best rated people/genres
+    """
+    return rank_category_index(index, min_num_of_movies, num_of_influencers,
+                               year)[0].tolist()
+
+
+@profiling.stage('filter_category')
+def filter_category(category, influencers):
+    """
+    Ignore values not in the list of influencers. All the lists of the column
+    are filtered at once on their flattened (coded) values
+    :param category: Series, lists of coded influencing points in a category
+    :param influencers: List, codes of the most popular infleuncing points
+    :return: Series, lists of only popular influencers (NaN if there are none)
+    """
+    lengths, values = columnar.flatten_list_column(category, ID_DTYPE)
+    keep = np.isin(values, np.asarray(influencers, dtype=ID_DTYPE))
+    rows = np.repeat(np.arange(len(category)), lengths)[keep]
+    new_lengths = np.bincount(rows, minlength=len(category))
+    new_lists = columnar.group_into_lists(values[keep], new_lengths)
+    return pd.Series(new_lists, index=category.index, dtype=object)
 
 
 def get_filtered_wikidata(wikidata_file, category, rating,
                           min_num_of_movies=5,
                           num_of_influencers=50,
-                          year=None):
+                          year=None,
+                          exact=False):
     """
-    Filter the movie database and select the category and
+    Filter the movie database and select the category, from the default
+    session (see MovieSession.filtered_wikidata)
     :param wikidata_file: String, name of the wikidata file
     :param category: String, category of interest (genre, cast_member, director)
     :param rating: String, type of rating to focus
     :param min_num_of_movies: int, filter out any with less than
     :param num_of_influencers: int, number of popular categories to use
-    :return: dataframe, movies by category
+    :param year: List, start (inclusive) and end (exclusive) year
+    :param exact: bool, find the most influential from the full movie table
+    instead of the aggregate index
+    :return: dataframe, movies by category (coded, see encode_ids)
     """
+    return default_session().filtered_wikidata(
+        wikidata_file, category, rating, min_num_of_movies,
+        num_of_influencers, year, exact)
+
+
+def query_params(category, score, min_movies, n, years=None, exact=False):
     """
-    Get the notable points (cast members, directors, genres) of a movie and the
-    score in question (money return or rotten tomatoes score)
-    :param wikidata_file: String, name of the wikidata movie file
-    :param score: string, rating to focus on
-    :return: Dataframe, filtered dataframe with all notable points
+    Parameters of a movie data query that change its result
+    :return: dict, json serializable parameters
     """
-    print("DEBUG: Start wikidata filter")
-    wikidata_df = json_to_df(wikidata_file)
-    wikidata_df = prep_wikidata(wikidata_df, category, rating, year)
+    return {'category': category,
+            'score': score,
+            'movies': min_movies,
+            'influencers': n,
+            'year': list(years) if years else None,
+            'exact': exact}
 
-    print("DEBUG: Get most influential ")
-    influencers = get_best_rated(wikidata_df, category, rating,
-                                 min_num_of_movies,
-                                 num_of_influencers)
-    wikidata_df[category] = wikidata_df[category].apply(
-        filter_category,
-        influencers=influencers)
 
-    cleaned_wikidata_df = wikidata_df[['label', 'publication_date',
-                                       category, rating]].dropna()
+def movie_data_params(args):
+    """
+    Parameters of get_movie_data that change its result
+    :param args: Namespace, command line arguments
+    :return: dict, json serializable parameters
+    """
+    return query_params(args.category, args.score, args.movies,
+                        args.influencers, args.year,
+                        getattr(args, 'exact', False))
 
-    return cleaned_wikidata_df
+
+def input_digests(files, json_path=JSON_PATH, cache_prefix=''):
+    """
+    :param files: List, names of files in data/json
+    :param json_path: String, path of the files, with {} for their name
+    :param cache_prefix: String, prefix of their columnar cache entries
+    :return: dict, name of each file to the sha1 of its contents
+    """
+    return {file: columnar.source_digest(cache_prefix + file,
+                                         path.abspath(json_path.format(file)))
+            for file in files}
 
 
-def get_movie_data(filename, args):
+def code_version():
     """
-    Based on the parameters, filter and clean the data and create a json file.
-    If the json file is already created, use that instead.
-    :return: dataframe, movie data
+    :return: String, version of the code that produces cached results
     """
-    if path.isfile(JSON_PATH.format(filename)):
-        data = json_to_df(filename)
-    else:
-        data = get_filtered_wikidata('wikidata-movies', args.category,
-                                        args.score, args.movies,
-                                        args.influencers, args.year)
-        data = explode_dataframe_by_column(data, args.category)
-        data = map_wikidata_id(data, args.category)
-        df_to_json(data, filename)
+    return result_cache.code_version([path.abspath(__file__),
+                                      columnar.__file__,
+                                      result_cache.__file__])
 
-    return data
+
+def query_inputs(category, score):
+    """
+    :return: List, names of the files read by a movie data query
+    """
+    inputs = ['wikidata-movies', category]
+    if score != 'return':
+        inputs.append('rotten-tomatoes')
+    return inputs
+
+
+class MovieSession:
+    """
+    Loaded movie, rotten tomatoes and label tables, kept in memory with
+    everything derived from them (prepared wikidata, aggregate indexes and
+    query results), so a notebook or a service can load once and run many
+    queries. Tables are only read when a query first needs them. Results
+    are shared between queries: don't modify them. Only the max_results most
+    recently used query results are kept, and clear() frees everything.
+
+    Each session has its own integer codes of the wikidata ids (see
+    encode_ids): only pass coded data to the session that made it.
+    """
+
+    def __init__(self, json_path=JSON_PATH, use_cache=True, cache_prefix='',
+                 max_results=MAX_SESSION_RESULTS):
+        """
+        :param json_path: String, path of the json.gz files, with {} for
+        their name
+        :param use_cache: bool, read and write the result cache in
+        data/cache (the tables always go through the columnar cache)
+        :param cache_prefix: String, prefix of the columnar cache entries of
+        the tables, eg a folder for files that aren't the ones in data/json
+        :param max_results: int, number of query results kept in memory
+        """
+        self.json_path = json_path
+        self.use_cache = use_cache
+        self.cache_prefix = cache_prefix
+        self.max_results = max_results
+        self._tables = {}
+        self._id_dictionary = {}
+        self._digests = {}
+        self._rt_scores = {}
+        self._labels = {}
+        self._prepped = {}
+        self._category_indexes = {}
+        # keys of the indexes rebuilt by a refresh
+        self._refreshed = set()
+        self._results = OrderedDict()
+
+    def clear(self):
+        """
+        Forget the loaded tables and everything derived from them (the codes
+        of the wikidata ids too: coded data from before can't be used after).
+        The next queries read the files again, and notice if they changed
+        """
+        self._tables.clear()
+        self._id_dictionary.clear()
+        self._digests.clear()
+        self._rt_scores.clear()
+        self._labels.clear()
+        self._prepped.clear()
+        self._category_indexes.clear()
+        self._refreshed.clear()
+        self._results.clear()
+
+    @profiling.stage('json_to_df')
+    def table(self, file, columns=None):
+        """
+        A json.gz file as a dataframe, read once per session
+        :param file: String, name of the file
+        :param columns: list, columns to load (default all)
+        :return: dataframe of the json file
+        """
+        key = (file, tuple(columns) if columns is not None else None)
+        if key not in self._tables:
+            self._tables[key] = columnar.cached_read(
+                self.cache_prefix + file,
+                path.abspath(self.json_path.format(file)),
+                read_json_gz, columns, READER_VERSION)
+        return self._tables[key]
+
+    def id_dictionary(self):
+        """
+        Codes of the wikidata ids, built from the label maps of CATEGORIES
+        next to the session's files (if there are any). Ids that are not in
+        any label map are added as they are encoded
+        :return: Index, wikidata ids in order of their code
+        """
+        if 'ids' not in self._id_dictionary:
+            ids = []
+            for category in CATEGORIES:
+                if not path.isfile(self.json_path.format(category)):
+                    continue
+                category_df = self.table(category, ['wikidata_id'])
+                if 'wikidata_id' in category_df:
+                    ids.append(category_df['wikidata_id'].values)
+            ids = np.concatenate(ids) if ids else np.empty(0, dtype=object)
+            self._id_dictionary['ids'] = pd.Index(pd.unique(ids))
+        return self._id_dictionary['ids']
+
+    def encode_ids(self, ids):
+        """
+        Convert wikidata ids to their integer codes in this session
+        :param ids: array, wikidata ids
+        :return: array of ID_DTYPE codes
+        """
+        dictionary = self.id_dictionary()
+        codes = dictionary.get_indexer(ids)
+        unknown = codes < 0
+        if unknown.any():
+            new_ids = pd.unique(np.asarray(ids, dtype=object)[unknown])
+            dictionary = dictionary.append(pd.Index(new_ids))
+            self._id_dictionary['ids'] = dictionary
+            codes[unknown] = dictionary.get_indexer(
+                np.asarray(ids, dtype=object)[unknown])
+        return codes.astype(ID_DTYPE)
+
+    def input_digests(self, files):
+        """
+        Digests of the input files, taken when the session first uses them
+        so cache keys match the tables held in memory
+        :param files: List, names of the files
+        :return: dict, name of each file to the sha1 of its contents
+        """
+        missing = [file for file in files if file not in self._digests]
+        self._digests.update(input_digests(missing, self.json_path,
+                                           self.cache_prefix))
+        return {file: self._digests[file] for file in files}
+
+    def query_key(self, params):
+        """
+        Key of the result cache entry of a query
+        :param params: dict, as returned by query_params
+        :return: String, cache key
+        """
+        inputs = query_inputs(params['category'], params['score'])
+        return result_cache.make_key(params, self.input_digests(inputs),
+                                     code_version())
+
+    def rt_scores(self, rating):
+        """
+        One rotten tomatoes score indexed by rotten_tomatoes_id, without the
+        movies missing it. Only the ids and the requested column are loaded
+        :param rating: String, type of rating to focus
+        :return: Series, score of each movie
+        """
+        if rating not in self._rt_scores:
+            ids = self.table('rotten-tomatoes', ['rotten_tomatoes_id'])
+            scores = self.table('rotten-tomatoes', [rating])[rating]
+            scores = pd.Series(scores.values,
+                               index=pd.Index(ids['rotten_tomatoes_id'].values))
+            scores = scores.dropna()
+            self._rt_scores[rating] = scores[~scores.index.duplicated()]
+        return self._rt_scores[rating]
+
+    def labels(self, category):
+        """
+        Label lookup for the wikidata ids of a category
+        :param category: String, name of the label map (genre, cast_member,
+        director)
+        :return: tuple, (Index of wikidata ids, labels in the same order
+        followed by a NaN for unknown ids)
+        """
+        if category not in self._labels:
+            category_df = self.table(category)
+            label_columns = [c for c in category_df.columns
+                             if c != 'wikidata_id']
+            if label_columns:
+                category_df = category_df.drop_duplicates('wikidata_id',
+                                                          keep='last')
+                ids = category_df['wikidata_id'].values
+                labels = category_df[label_columns[0]].values
+            else:
+                ids = labels = []
+            table = np.empty(len(labels) + 1, dtype=object)
+            table[:-1] = labels
+            table[-1] = np.nan
+            self._labels[category] = (pd.Index(ids), table)
+        return self._labels[category]
+
+    def prepped(self, category, rating, wikidata_file='wikidata-movies'):
+        """
+        prep_wikidata of a whole wikidata file without a year bound, so each
+        (category, rating) is only coded and merged once
+        :param category: String, column of interest
+        :param rating: String, type of rating to focus
+        :param wikidata_file: String, name of the wikidata file
+        :return: dataframe, as returned by prep_wikidata
+        """
+        key = (wikidata_file, category, rating)
+        if key not in self._prepped:
+            self._prepped[key] = prep_wikidata(self.table(wikidata_file),
+                                               category, rating, None,
+                                               session=self)
+        return self._prepped[key]
+
+    def category_index(self, category, rating, refresh=False,
+                       use_cache=None):
+        """
+        Get the aggregate index of a category and rating, building it from the
+        wikidata file the first time. Indexes are also kept in the result
+        cache (if the session uses it), and are rebuilt when the inputs or
+        code change
+        :param category: String, column of interest
+        :param rating: String, type of rating to focus
+        :param refresh: bool, rebuild the index even if it is cached (once
+        per session: an index this session already rebuilt is kept)
+        :param use_cache: bool, read and write the result cache (default: as
+        the session was created)
+        :return: dict, as returned by prepare_category_index
+        """
+        if use_cache is None:
+            use_cache = self.use_cache
+        inputs = ['wikidata-movies']
+        if rating != 'return':
+            inputs.append('rotten-tomatoes')
+        params = {'index': category, 'score': rating}
+        key = result_cache.make_key(params, self.input_digests(inputs),
+                                    code_version())
+
+        if refresh and key in self._refreshed:
+            refresh = False
+        if not refresh and key in self._category_indexes:
+            return self._category_indexes[key]
+        index = None
+        if use_cache and not refresh:
+            index = result_cache.get_result(key)
+        if index is None:
+            wikidata_df = self.prepped(category, rating)
+            index = build_category_index(wikidata_df, category, rating,
+                                         self)
+            if use_cache:
+                result_cache.put_result(key, index, params)
+        if refresh:
+            self._refreshed.add(key)
+        self._category_indexes[key] = prepare_category_index(index, category,
+                                                             self)
+        return self._category_indexes[key]
+
+    def _rank(self, wikidata_df, category, rating, min_num_of_movies,
+             num_of_influencers, year=None, exact=False,
+             wikidata_file='wikidata-movies', refresh=False, use_cache=None):
+        """
+        The best rated people/genres, from the aggregate index or, with
+        'exact' (or another wikidata file), from the full movie table
+        :param wikidata_df: Dataframe, prepared wikidata within the years
+        :param refresh: bool, rebuild the aggregate index
+        :param use_cache: bool, read and write the aggregate index in the
+        result cache (default: as the session was created)
+        :return: tuple of arrays, as returned by rank_category_index
+        """
+        if exact or wikidata_file != 'wikidata-movies':
+            data = avg_by_category(wikidata_df, category, rating)
+            best = get_top(data, rating, min_num_of_movies,
+                           num_of_influencers,
+                           decode_ids(data[category].values, self))
+            return (best[category].values, best[rating].values,
+                    best['movies'].values)
+        index = self.category_index(category, rating, refresh, use_cache)
+        return rank_category_index(index, min_num_of_movies,
+                                   num_of_influencers, year)
+
+    @profiling.stage('get_filtered_wikidata')
+    def filtered_wikidata(self, wikidata_file, category, rating,
+                          min_num_of_movies=5, num_of_influencers=50,
+                          year=None, exact=False, refresh=False,
+                          use_cache=None):
+        """
+        Get the notable points (cast members, directors, genres) of a movie
+        and the score in question (money return or rotten tomatoes score)
+        :param wikidata_file: String, name of the wikidata file
+        :param category: String, category of interest (genre, cast_member,
+        director)
+        :param rating: String, type of rating to focus
+        :param min_num_of_movies: int, filter out any with less than
+        :param num_of_influencers: int, number of popular categories to use
+        :param year: List, start (inclusive) and end (exclusive) year
+        :param exact: bool, find the most influential from the full movie
+        table instead of the aggregate index
+        :param refresh: bool, rebuild the aggregate index
+        :param use_cache: bool, read and write the aggregate index in the
+        result cache (default: as the session was created)
+        :return: dataframe, movies by category (coded, see encode_ids)
+        """
+        print("DEBUG: Start wikidata filter")
+        wikidata_df = self.prepped(category, rating, wikidata_file)
+        wikidata_df = filter_years(wikidata_df, year)
+
+        print("DEBUG: Get most influential ")
+        influencers = self._rank(wikidata_df, category, rating,
+                                min_num_of_movies, num_of_influencers, year,
+                                exact, wikidata_file, refresh, use_cache)[0]
+        wikidata_df = wikidata_df.assign(**{
+            category: filter_category(wikidata_df[category], influencers)})
+
+        return wikidata_df[['label', 'publication_date', 'year', 'decade',
+                            category, rating]].dropna()
+
+    def top_entities(self, category, score, min_movies=40, n=25, years=None,
+                     exact=False):
+        """
+        The best rated people/genres and their average score
+        :param category: String, category of interest (genre, cast_member,
+        director)
+        :param score: String, score to rank by
+        :param min_movies: int, filter out any with less movies
+        :param n: int, number of people/genres
+        :param years: List, start (inclusive) and end (exclusive) year
+        :param exact: bool, rank from the full movie table instead of the
+        aggregate index
+        :return: Dataframe, best first, columns category (labels),
+        'wikidata_id', score (average) and 'movies'
+        """
+        wikidata_df = filter_years(self.prepped(category, score), years)
+        codes, mean, count = self._rank(wikidata_df, category, score,
+                                       min_movies, n, years, exact)
+        return pd.DataFrame({
+            category: label_ids(codes, category, self),
+            'wikidata_id': decode_ids(codes, self),
+            score: mean,
+            'movies': count},
+            columns=[category, 'wikidata_id', score, 'movies'])
+
+    @profiling.stage('get_movie_data')
+    def filtered_movies(self, category, score, min_movies=40, n=25,
+                        years=None, exact=False, refresh=False,
+                        use_cache=None):
+        """
+        One row per movie and best rated person/genre in it, with the score
+        and the label of the person/genre. Results are kept in memory (the
+        max_results last used) and, if the session uses it, in the result
+        cache
+        :param category: String, category of interest (genre, cast_member,
+        director)
+        :param score: String, score to focus on
+        :param min_movies: int, filter out people/genres with less movies
+        :param n: int, number of people/genres
+        :param years: List, start (inclusive) and end (exclusive) year
+        :param exact: bool, rank from the full movie table instead of the
+        aggregate index
+        :param refresh: bool, rebuild the data and the aggregate index and
+        replace the cached copies
+        :param use_cache: bool, read and write the result cache, for the data
+        and the aggregate index (default: as the session was created)
+        :return: dataframe, movie data
+        """
+        if use_cache is None:
+            use_cache = self.use_cache
+        params = query_params(category, score, min_movies, n, years, exact)
+        key = self.query_key(params)
+        data = None if refresh else self._results.get(key)
+        if data is None and use_cache and not refresh:
+            data = result_cache.get_result(key)
+
+        if data is None:
+            data = self.filtered_wikidata('wikidata-movies', category, score,
+                                          min_movies, n, years, exact,
+                                          refresh, use_cache)
+            data = explode_dataframe_by_column(data, category, ID_DTYPE)
+            data = map_wikidata_id(data, category, self)
+            if use_cache:
+                result_cache.put_result(key, data, params)
+        self._results[key] = data
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+        return data
+
+
+def default_session():
+    """
+    The session used by the module level functions, created on first use
+    :return: MovieSession
+    """
+    if 'default' not in _sessions:
+        _sessions['default'] = MovieSession()
+    return _sessions['default']
+
+
+def get_movie_data(args):
+    """
+    Based on the parameters, filter and clean the data and save it to the
+    result cache. If it is already cached, use that instead.
+    'args.no_cache' skips the cache entirely and 'args.refresh' rebuilds the
+    data and replaces the cached copy
+    :param args: Namespace, command line arguments
+    :return: dataframe, movie data
+    """
+    return default_session().filtered_movies(
+        args.category, args.score, args.movies, args.influencers, args.year,
+        getattr(args, 'exact', False), getattr(args, 'refresh', False),
+        use_cache=not getattr(args, 'no_cache', False))
 
 
 def main():
@@ -4,73 +4,247 @@ Written by ggbaker
 
 
 import requests
-import json, glob, dbm, sys
+import argparse
+import json, glob, dbm, os, queue, threading, time
+import numpy as np
 import pandas as pd
 
-API_KEY = sys.argv[1]
+import omdb_cache
+from omdb_cache import NOT_FOUND
+
+OMDB_URL = 'http://www.omdbapi.com/'
+# the old cache, before omdb_cache
 cachefile = 'omdb-cache.dbm'
-NOT_FOUND = 'notfound'
-request_limit = False
+REQUEST_LIMIT = 'Request limit reached!'
 
 
-def get_omdb_data(imdb_id):
+class RequestLimitReached(Exception):
     """
-    Fetch this IMDb ID from the OMDb API.
+    The API key has no requests left (for today)
+    """
+
+
+class TokenBucket:
+    """
+    Rate limit shared by the fetching threads: 'rate' requests per second on
+    average, with bursts of up to 'capacity' requests
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Wait until a request can be made
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            # a negative balance is the time this request has to wait for
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def make_session(workers):
+    """
+    HTTP session keeping one connection alive per fetching thread
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_omdb_data(session, imdb_id, api_key, url=OMDB_URL, bucket=None,
+                  retries=3, backoff=1.0):
+    """
+    Fetch this IMDb ID from the OMDb API. Connection errors, 429 and 5xx
+    responses are retried after backoff, 2*backoff, 4*backoff... seconds
+    :return: dict, the OMDb data, or NOT_FOUND
+    :raise RequestLimitReached: once the API key has no requests left
     """
-    global request_limit
-    if request_limit:
-        # after we hit the limit, stop trying.
-        return None
     if not imdb_id.startswith('tt'):
         raise ValueError('movies only')
 
-    url = 'http://www.omdbapi.com/?i=%s&apikey=%s&plot=full' % (imdb_id, API_KEY)
-    print('fetching', url)
-    r = requests.get(url)
-
-    data = json.loads(r.text)
-    if data['Response'] == 'False':
-        if data['Error'] == 'Error getting data.':
-            return NOT_FOUND
-        elif data['Error'] == 'Request limit reached!':
-            request_limit = True
-            return None
-        else:
-            raise ValueError(data['Error'])
+    params = {'i': imdb_id, 'apikey': api_key, 'plot': 'full'}
+    for attempt in range(retries + 1):
+        if bucket is not None:
+            bucket.take()
+        try:
+            r = session.get(url, params=params, timeout=30)
+            if r.status_code == 429 or r.status_code >= 500:
+                r.raise_for_status()
+        except requests.RequestException:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+            continue
 
-    return data
+        data = json.loads(r.text)
+        if data['Response'] == 'False':
+            if data['Error'] == 'Error getting data.':
+                return NOT_FOUND
+            elif data['Error'] == REQUEST_LIMIT:
+                raise RequestLimitReached(imdb_id)
+            else:
+                raise ValueError(data['Error'])
+        return data
 
 
-def get_omdb_data_cache(imdb_id):
+def richness(movie_data):
     """
-    Get OMDb data, but cache in cachefile, so we don't hammer the same URL multiple times.
+    How much wikidata knows about each movie, to fetch the most interesting
+    ones before hitting the rate limit: the number of values in the list
+    columns plus the number of other non-null fields
+    :param movie_data: Dataframe, the wikidata-movies table
+    :return: array, score of each row
     """
-    db = dbm.open(cachefile, 'cs')
-    try:
-        data = json.loads(db[imdb_id])
+    score = np.zeros(len(movie_data), dtype=np.int64)
+    for column in movie_data.columns:
+        values = movie_data[column]
+        present = values.dropna()
+        if len(present) and isinstance(present.iloc[0], list):
+            score += values.str.len().fillna(0).values.astype(np.int64)
+        else:
+            score += values.notnull().values
+    return score
+
+
+def fetch_all(imdb_ids, db, api_key, url=OMDB_URL, rate=10, workers=8,
+              retries=3, keep_raw=True, priorities=None, backoff=1.0):
+    """
+    Fetch the OMDb data of every IMDb ID not in the cache yet, in parallel.
+    Every response is cached as soon as it arrives, so after the request limit
+    is reached a later run picks up where this one stopped
+    :param imdb_ids: iterable, IMDb IDs to fetch
+    :param db: Connection, from omdb_cache.open_cache
+    :param api_key: String, OMDb API key
+    :param url: String, OMDb API url (eg a local stand-in server)
+    :param rate: float, maximum requests per second
+    :param workers: int, number of fetching threads
+    :param retries: int, attempts after the first one for failed requests
+    :param keep_raw: bool, also cache the whole responses
+    :param priorities: iterable, score of each IMDb ID: the highest are
+    fetched first (default: in the order given)
+    :param backoff: float, seconds before the first retry (see get_omdb_data)
+    :return: tuple, (number of IDs fetched, True if the limit was reached)
+    """
+    imdb_ids = list(imdb_ids)
+    if priorities is None:
+        priorities = range(len(imdb_ids), 0, -1)
+    done = omdb_cache.cached_ids(db)
+    todo = queue.PriorityQueue()
+    # ties are fetched in the order given
+    for order, (imdb_id, priority) in enumerate(zip(imdb_ids, priorities)):
+        if imdb_id not in done:
+            todo.put((-priority, order, imdb_id))
+
+    session = make_session(workers)
+    bucket = TokenBucket(rate)
+    limit_reached = threading.Event()
+    db_lock = threading.Lock()
+    fetched = []
+    errors = []
 
-    except KeyError:
-        data = get_omdb_data(imdb_id)
-        if data is not None:
-            db[imdb_id] = json.dumps(data)
+    def fetch():
+        # after we hit the limit, stop trying.
+        while not limit_reached.is_set() and not errors:
+            try:
+                imdb_id = todo.get_nowait()[2]
+            except queue.Empty:
+                return
+            try:
+                data = get_omdb_data(session, imdb_id, api_key, url, bucket,
+                                     retries, backoff)
+            except RequestLimitReached:
+                limit_reached.set()
+                return
+            except Exception as e:
+                errors.append(e)
+                return
+            with db_lock:
+                omdb_cache.put_many(db, [(imdb_id, data)], keep_raw)
+                fetched.append(imdb_id)
+                # one thread prints at a time
+                print('fetched', imdb_id)
+
+    threads = [threading.Thread(target=fetch) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    session.close()
+    if errors:
+        raise errors[0]
+    return len(fetched), limit_reached.is_set()
 
-    if data == NOT_FOUND:
-        return None
 
-    return data
+def get_omdb_data_cache(db, imdb_ids):
+    """
+    Get OMDb data from the cache filled by fetch_all, so we don't hammer the same URL multiple times.
+    :return: List, dict of omdb_cache.FIELDS for each IMDb ID, or None if the movie isn't cached or OMDb doesn't have it
+    """
+    cached = omdb_cache.get_many(db, imdb_ids)
+    return [None if cached.get(i, NOT_FOUND) == NOT_FOUND else cached[i]
+            for i in imdb_ids]
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Fetch the OMDb data of the movies in wikidata-movies")
+    parser.add_argument('api_key', help="OMDb API key")
+    parser.add_argument('--url', default=OMDB_URL, help="OMDb API url")
+    parser.add_argument('--rate', '-r', type=float, default=10,
+                        help="Maximum requests per second")
+    parser.add_argument('--workers', '-w', type=int, default=8,
+                        help="Number of fetching threads")
+    parser.add_argument('--retries', type=int, default=3,
+                        help="Retries of failed requests")
+    parser.add_argument('--cache', default=omdb_cache.CACHE_FILE,
+                        help="OMDb cache file")
+    parser.add_argument('--no-raw', action='store_true',
+                        help="Only cache the fields we use, not the whole "
+                             "responses")
+    parser.add_argument('--compact', action='store_true',
+                        help="Compact the cache (dropping the raw responses "
+                             "with --no-raw) when done")
+    args = parser.parse_args()
+
+    db = omdb_cache.open_cache(args.cache)
+    if dbm.whichdb(cachefile):
+        # one-shot: the old file is renamed once it has been copied
+        print('migrated {} movies from {}'.format(
+            omdb_cache.migrate_dbm(db, cachefile, not args.no_raw), cachefile))
+        for f in glob.glob(cachefile + '*'):
+            os.replace(f, f + '.migrated')
+
     infile = glob.glob('./wikidata-movies/part*')[0]
     #infile = './wikidata-movies.json.gz'
     movie_data = pd.read_json(infile, orient='records', lines=True)
 
-    # hacky heuristic to fetch most interesting before hitting the rate limit: longest data rows first
-    movie_data['len'] = movie_data.apply(lambda s: len(json.dumps(s.to_dict())), axis=1)
-    movie_data = movie_data.sort_values('len', ascending=False).reset_index()
-    #movie_data = movie_data.truncate(after=10)
-
-    movie_data['omdb'] = movie_data['imdb_id'].apply(get_omdb_data_cache)
+    try:
+        fetched, limit_reached = fetch_all(
+            movie_data['imdb_id'], db, args.api_key, args.url, args.rate,
+            args.workers, args.retries, not args.no_raw,
+            richness(movie_data))
+        print('fetched {} movies'.format(fetched))
+        if limit_reached:
+            print('Request limit reached: run again later to fetch the rest')
+        movie_data['omdb'] = get_omdb_data_cache(db, movie_data['imdb_id'].tolist())
+        if args.compact:
+            omdb_cache.compact(db, keep_raw=not args.no_raw)
+    finally:
+        db.close()
     movie_data = movie_data[movie_data['omdb'].notnull()]
 
     # extract the data we care about...
@@ -83,4 +257,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,139 @@
+"""
+Cache of the OMDb API responses, used by get_omdb_data.py.
+
+One SQLite table in WAL mode, so the cache can be read by several processes
+while it is being filled. Only the fields we use (Genre, Plot, Awards) are
+kept in their own columns; the raw response can be dropped by compact().
+Movies OMDb doesn't have are cached too (found = 0) so they aren't fetched
+again.
+"""
+import dbm
+import json
+import sqlite3
+import time
+
+CACHE_FILE = 'omdb-cache.sqlite'
+NOT_FOUND = 'notfound'
+FIELDS = ['Genre', 'Plot', 'Awards']
+# SQLite limits the number of parameters of a statement
+BATCH_SIZE = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS omdb (
+    imdb_id TEXT PRIMARY KEY,
+    found INTEGER NOT NULL,
+    genre TEXT,
+    plot TEXT,
+    awards TEXT,
+    raw TEXT,
+    fetched REAL
+)
+'''
+
+
+def open_cache(file=CACHE_FILE):
+    """
+    Open (and create if needed) the cache. The connection can be shared by
+    threads, as long as they don't write at the same time
+    :param file: String, path of the SQLite file
+    :return: sqlite3 Connection
+    """
+    db = sqlite3.connect(file, timeout=30, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute(SCHEMA)
+    db.commit()
+    return db
+
+
+def _batches(values):
+    values = list(values)
+    for start in range(0, len(values), BATCH_SIZE):
+        yield values[start:start + BATCH_SIZE]
+
+
+def cached_ids(db):
+    """
+    :param db: Connection, from open_cache
+    :return: set, every IMDb ID in the cache (found or not)
+    """
+    return {row[0] for row in db.execute('SELECT imdb_id FROM omdb')}
+
+
+def get_many(db, imdb_ids):
+    """
+    Look up many IMDb IDs at once
+    :param db: Connection, from open_cache
+    :param imdb_ids: iterable, IMDb IDs
+    :return: dict, IMDb ID to a dict of FIELDS, or to NOT_FOUND. IDs that
+    aren't cached are left out
+    """
+    result = {}
+    for batch in _batches(set(imdb_ids)):
+        query = ('SELECT imdb_id, found, genre, plot, awards FROM omdb '
+                 'WHERE imdb_id IN ({})'.format(', '.join('?' * len(batch))))
+        for imdb_id, found, genre, plot, awards in db.execute(query, batch):
+            if found:
+                result[imdb_id] = dict(zip(FIELDS, (genre, plot, awards)))
+            else:
+                result[imdb_id] = NOT_FOUND
+    return result
+
+
+def put_many(db, items, keep_raw=True):
+    """
+    Add (or replace) many responses in one transaction
+    :param db: Connection, from open_cache
+    :param items: iterable of (IMDb ID, OMDb data dict or NOT_FOUND)
+    :param keep_raw: bool, also store the whole response as JSON
+    """
+    now = time.time()
+    rows = []
+    for imdb_id, data in items:
+        if data == NOT_FOUND:
+            rows.append((imdb_id, 0, None, None, None, None, now))
+        else:
+            rows.append((imdb_id, 1) +
+                        tuple(data.get(f) for f in FIELDS) +
+                        (json.dumps(data) if keep_raw else None, now))
+    with db:
+        db.executemany('INSERT OR REPLACE INTO omdb VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       rows)
+
+
+def compact(db, keep_raw=False):
+    """
+    Shrink the cache file: drop the raw responses (unless keep_raw), rebuild
+    the table and fold the WAL back into the main file
+    :param db: Connection, from open_cache
+    :param keep_raw: bool, keep the raw responses
+    """
+    if not keep_raw:
+        with db:
+            db.execute('UPDATE omdb SET raw = NULL WHERE raw IS NOT NULL')
+    db.execute('VACUUM')
+    db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+def migrate_dbm(db, dbm_file, keep_raw=True):
+    """
+    Copy every entry of the old dbm cache (JSON blobs, or NOT_FOUND) into the
+    SQLite cache. Entries already in the SQLite cache are kept as they are
+    :param db: Connection, from open_cache
+    :param dbm_file: String, path of the dbm cache
+    :param keep_raw: bool, also store the whole responses
+    :return: int, number of entries copied
+    """
+    old = dbm.open(dbm_file, 'r')
+    try:
+        done = cached_ids(db)
+        items = []
+        for key in old.keys():
+            imdb_id = key.decode('utf-8')
+            if imdb_id not in done:
+                items.append((imdb_id, json.loads(old[key])))
+    finally:
+        old.close()
+    for batch in _batches(items):
+        put_many(db, batch, keep_raw)
+    return len(items)
@@ -0,0 +1,197 @@
+"""
+Timing of the stages of the pipeline.
+
+Functions decorated with stage() record, while recording is enabled, their
+wall time, the number of rows they get and return and the peak memory they
+allocate (traced with tracemalloc). The records are collected as a list of
+dicts, ready to be written as JSON. While recording is disabled a stage only
+costs a flag check, so the decorators stay on the functions.
+
+profiled() runs a block under cProfile (or pyinstrument, for .html files) and
+dumps the profile, for the hot spots inside the stages.
+"""
+import functools
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_state = {'enabled': False, 'memory': False}
+_records = []
+# peak memory of the stages running, innermost last
+_running = []
+
+
+def enable(memory=True):
+    """
+    Start recording the stages
+    :param memory: bool, also trace the peak memory (makes allocations slower)
+    """
+    _state['enabled'] = True
+    _state['memory'] = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """
+    Stop recording the stages
+    """
+    _state['enabled'] = False
+    if _state['memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _state['memory'] = False
+
+
+def collect():
+    """
+    :return: List of dict, records of the stages run since the last collect,
+    in the order they finished
+    """
+    records = list(_records)
+    del _records[:]
+    return records
+
+
+def count_rows(value):
+    """
+    :param value: anything, argument or result of a stage
+    :return: int, number of rows of a dataframe, series or array, else None
+    """
+    if hasattr(value, 'shape') and len(value.shape):
+        return int(value.shape[0])
+    return None
+
+
+def _first_rows(values):
+    for value in values:
+        rows = count_rows(value)
+        if rows is not None:
+            return rows
+    return None
+
+
+def _start_memory():
+    if not _state['memory']:
+        return None
+    current, peak = tracemalloc.get_traced_memory()
+    if _running:
+        _running[-1] = max(_running[-1], peak)
+    if hasattr(tracemalloc, 'reset_peak'):
+        # python < 3.9 can't reset it: peaks are then since the start
+        tracemalloc.reset_peak()
+    _running.append(current)
+    return current
+
+
+def _end_memory(start):
+    if start is None:
+        return None
+    peak = max(_running.pop(), tracemalloc.get_traced_memory()[1])
+    if _running:
+        _running[-1] = max(_running[-1], peak)
+    return peak - start
+
+
+def stage(name):
+    """
+    Decorator recording a function as a stage of the pipeline. Rows in are
+    those of the first dataframe/series/array argument, rows out those of the
+    result
+    :param name: String, name of the stage in the records
+    :return: decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return function(*args, **kwargs)
+            rows_in = _first_rows(args)
+            memory = _start_memory()
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                peak = _end_memory(memory)
+            _records.append({'stage': name,
+                             'seconds': seconds,
+                             'rows_in': rows_in,
+                             'rows_out': count_rows(result),
+                             'peak_bytes': peak})
+            return result
+        return wrapper
+    return decorator
+
+
+def write_json(report, file):
+    """
+    Write a report of the stages
+    :param report: dict, json serializable
+    :param file: String, path of the JSON file, '-' for the standard output
+    """
+    if file == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(file, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+@contextmanager
+def profiled(file):
+    """
+    Profile the block and dump the profile to 'file': pyinstrument's HTML
+    report if the name ends with .html (pyinstrument must be installed),
+    else cProfile's stats (read them with pstats or snakeviz)
+    :param file: String, path of the dump, None to run without profiling
+    """
+    if not file:
+        yield
+    elif file.endswith('.html'):
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(file, 'w') as f:
+                f.write(profiler.output_html())
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(file)
+
+
+def run(function, timings=None, profile=None, info=None):
+    """
+    Call 'function' with its stages recorded and/or profiled
+    :param function: function without arguments, eg a script's main stages
+    :param timings: String, JSON file of the stage records ('-' for the
+    standard output), None to not record them
+    :param profile: String, dump of the profile (see profiled)
+    :param info: dict, json serializable, saved with the records (eg the
+    configuration run)
+    :return: result of the function
+    """
+    if timings:
+        enable()
+    start = time.perf_counter()
+    try:
+        with profiled(profile):
+            result = function()
+    finally:
+        if timings:
+            disable()
+    if timings:
+        write_json({'config': info,
+                    'seconds': time.perf_counter() - start,
+                    'stages': collect()}, timings)
+    return result
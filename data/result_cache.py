@@ -0,0 +1,169 @@
+"""
+Cache of filtered movie data (the output of get_movie_data).
+
+Entries are keyed on a hash of the filter parameters, the fingerprints of the
+input files and the version of the code that produced them, so changing any
+of them gives a new entry instead of silently reusing an old one. Entries are
+stored with the columnar cache and listed in an index file recording their
+parameters, size and when they were last used. Once the entries take more than
+MAX_CACHE_BYTES, the least recently used ones are removed. The index is
+only read and rewritten under a lock file, so processes sharing the cache
+(eg sweep.py --jobs) don't lose each other's entries.
+"""
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from os import path
+
+try:
+    import fcntl
+except ImportError:
+    # no flock (Windows): index updates are not serialised
+    fcntl = None
+
+from data import columnar, profiling
+
+RESULTS = 'results'
+INDEX_FILE = path.join(columnar.CACHE_PATH, RESULTS, 'index.json')
+LOCK_FILE = INDEX_FILE + '.lock'
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def code_version(files):
+    """
+    Hash the source of the modules that produce the cached results
+    :param files: List, paths of the source files
+    :return: String, hex digest
+    """
+    sha1 = hashlib.sha1()
+    for file in files:
+        sha1.update(columnar.file_fingerprint(file)['sha1'].encode('ascii'))
+    return sha1.hexdigest()
+
+
+def make_key(params, inputs, code):
+    """
+    Build the key of a cache entry
+    :param params: dict, filter parameters (must be json serializable)
+    :param inputs: dict, name of each input file to its digest
+    :param code: String, version of the code
+    :return: String, hex digest identifying the entry
+    """
+    description = json.dumps({'params': params, 'inputs': inputs,
+                              'code': code}, sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def _entry_name(key):
+    return path.join(RESULTS, key)
+
+
+def read_index():
+    """
+    :return: dict, key of every entry to its parameters, size and last use
+    """
+    try:
+        with open(INDEX_FILE, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_index(index):
+    """
+    Replace the index file
+    :param index: dict, as returned by read_index
+    """
+    os.makedirs(path.dirname(INDEX_FILE), exist_ok=True)
+    tmp = columnar.temporary_name(INDEX_FILE)
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp, INDEX_FILE)
+
+
+@contextmanager
+def locked_index():
+    """
+    Hold the lock of the index for a read-modify-write of it
+    """
+    os.makedirs(path.dirname(LOCK_FILE), exist_ok=True)
+    with open(LOCK_FILE, 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+@profiling.stage('load_result')
+def get_result(key):
+    """
+    Load a cached result and mark it as recently used
+    :param key: String, key from make_key
+    :return: Dataframe, or None if it is not cached
+    """
+    data = columnar.load_columnar(_entry_name(key))
+    with locked_index():
+        index = read_index()
+        if data is None:
+            if index.pop(key, None) is not None:
+                write_index(index)
+            return None
+        if key in index:
+            index[key]['last_used'] = time.time()
+            write_index(index)
+    return data
+
+
+def put_result(key, data, params, max_bytes=MAX_CACHE_BYTES):
+    """
+    Save a result, then evict the least recently used entries if the cache is
+    over its size limit
+    :param key: String, key from make_key
+    :param data: Dataframe, result to be cached
+    :param params: dict, filter parameters, kept in the index for reference
+    :param max_bytes: int, size limit of the cache
+    """
+    name = _entry_name(key)
+    columnar.save_columnar(data, name)
+    with locked_index():
+        index = read_index()
+        now = time.time()
+        index[key] = {'params': params, 'size': columnar.columnar_size(name),
+                      'created': now, 'last_used': now}
+        evict(index, max_bytes)
+        write_index(index)
+
+
+def evict(index, max_bytes=MAX_CACHE_BYTES):
+    """
+    Remove the least recently used entries until the cache fits in max_bytes
+    :param index: dict, as returned by read_index (modified in place)
+    :param max_bytes: int, size limit of the cache
+    :return: List, keys of the removed entries
+    """
+    total = sum(entry['size'] for entry in index.values())
+    removed = []
+    by_age = sorted(index, key=lambda k: index[k]['last_used'])
+    for key in by_age:
+        # always keep the newest entry, even if it is larger than the limit
+        if total <= max_bytes or len(index) == 1:
+            break
+        total -= index.pop(key)['size']
+        columnar.remove_columnar(_entry_name(key))
+        removed.append(key)
+    return removed
+
+
+def clear():
+    """
+    Remove every cached result
+    """
+    with locked_index():
+        for key in read_index():
+            columnar.remove_columnar(_entry_name(key))
+        write_index({})
@@ -0,0 +1,203 @@
+"""
+Synthetic inputs shaped like the files in data/json, for benchmarks.
+
+generate() writes wikidata-movies, rotten-tomatoes and the genre, cast_member
+and director label maps as gzip json lines with the same columns as the real
+ones, at any number of movies. Genres and people are picked with a Zipf-like
+popularity, so a few of them are in many movies like in the real data, and
+cast sizes follow a Poisson distribution. The same parameters and seed give
+the same files.
+"""
+import gzip
+import json
+from os import path
+
+import numpy as np
+
+FILES = ['wikidata-movies', 'rotten-tomatoes', 'genre', 'cast_member',
+         'director']
+FIRST_YEAR = 1920
+LAST_YEAR = 2020
+# share of the movies without a publication date, with a box office and cost
+NO_DATE = 0.005
+WITH_RETURN = 0.02
+# share of the movies missing a rotten tomatoes score
+NO_SCORE = 0.05
+# prefix of the ids of each kind of entity, so they never collide
+ID_PREFIXES = {'movie': 'Q1', 'genre': 'Q2', 'cast_member': 'Q3',
+               'director': 'Q4'}
+
+
+def make_ids(kind, count):
+    """
+    :param kind: String, key of ID_PREFIXES
+    :param count: int, number of ids
+    :return: array of wikidata ids
+    """
+    return np.array(['{}{:08d}'.format(ID_PREFIXES[kind], i)
+                     for i in range(count)], dtype=object)
+
+
+def popular_choice(rng, count, size, exponent=1.0):
+    """
+    Draw entities with a Zipf-like popularity: the one of rank r is drawn in
+    proportion to 1 / r ** exponent
+    :param rng: RandomState
+    :param count: int, number of entities
+    :param size: int, number of draws
+    :param exponent: float, how much the first ranks dominate
+    :return: array of int positions of the entities drawn
+    """
+    weights = 1.0 / np.arange(1, count + 1) ** exponent
+    return rng.choice(count, size, p=weights / weights.sum())
+
+
+def draw_lists(rng, ids, lengths, exponent=1.0):
+    """
+    One list of popular ids per movie, without repeats inside a list
+    :param rng: RandomState
+    :param ids: array, ids to draw from
+    :param lengths: array, number of ids drawn for each movie
+    :param exponent: float, see popular_choice
+    :return: list of lists of ids (None for lengths of 0)
+    """
+    drawn = ids[popular_choice(rng, len(ids), lengths.sum(), exponent)]
+    ends = np.cumsum(lengths)
+    lists = []
+    for start, end in zip(ends - lengths, ends):
+        lists.append(list(dict.fromkeys(drawn[start:end])) if end > start
+                     else None)
+    return lists
+
+
+def publication_dates(rng, movies):
+    """
+    :param rng: RandomState
+    :param movies: int, number of movies
+    :return: list of dates, some of a year only and some missing (None)
+    """
+    years = rng.randint(FIRST_YEAR, LAST_YEAR, movies)
+    months = rng.randint(1, 13, movies)
+    days = rng.randint(1, 29, movies)
+    kind = rng.random_sample(movies)
+    dates = []
+    for year, month, day, k in zip(years, months, days, kind):
+        if k < NO_DATE:
+            dates.append(None)
+        elif k < 0.2:
+            dates.append('{}'.format(year))
+        else:
+            dates.append('{}-{:02d}-{:02d}'.format(year, month, day))
+    return dates
+
+
+def scores(rng, movies, mean, deviation, low, high, decimals=0):
+    """
+    :return: array of normal scores clipped to [low, high], NaN for NO_SCORE
+    of them
+    """
+    values = np.clip(rng.normal(mean, deviation, movies), low, high)
+    values = np.round(values, decimals)
+    values[rng.random_sample(movies) < NO_SCORE] = np.nan
+    return values
+
+
+def write_json_gz(records, file):
+    """
+    Write dicts as gzip json lines, leaving out the None values like the
+    real dumps
+    :param records: iterable of dict
+    :param file: String, path of the file
+    """
+    with gzip.open(file, 'wt', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps({k: v for k, v in record.items()
+                                if v is not None}, separators=(',', ':')))
+            f.write('\n')
+
+
+def _number(value):
+    return None if np.isnan(value) else float(value)
+
+
+def generate(directory, movies=10000, cast_mean=8.0, genre_mean=1.8,
+             genres=300, people=None, directors=None, seed=0):
+    """
+    Write synthetic inputs to 'directory' (as {name}.json.gz)
+    :param directory: String, folder of the files
+    :param movies: int, number of movies
+    :param cast_mean: float, average number of cast members of a movie
+    :param genre_mean: float, average number of genres of a movie (at least 1)
+    :param genres: int, number of genres
+    :param people: int, number of cast members (default 2 per movie)
+    :param directors: int, number of directors (default 1 per 4 movies)
+    :param seed: int, seed of the random data
+    :return: dict, name of each file to its number of lines
+    """
+    rng = np.random.RandomState(seed)
+    people = people or max(1, movies * 2)
+    directors = directors or max(1, movies // 4)
+    genre_ids = make_ids('genre', genres)
+    cast_ids = make_ids('cast_member', people)
+    director_ids = make_ids('director', directors)
+    movie_ids = make_ids('movie', movies)
+
+    genre_lists = draw_lists(
+        rng, genre_ids, 1 + rng.poisson(max(genre_mean - 1, 0), movies), 1.2)
+    cast_lists = draw_lists(rng, cast_ids, rng.poisson(cast_mean, movies))
+    director_lists = draw_lists(
+        rng, director_ids, rng.choice([0, 1, 2], movies, p=[.1, .85, .05]))
+    dates = publication_dates(rng, movies)
+    cost = np.round(10 ** rng.uniform(5, 8.5, movies), -3)
+    box_office = np.round(cost * rng.lognormal(0.5, 1.2, movies), -3)
+    with_return = rng.random_sample(movies) < WITH_RETURN
+
+    def movie_records():
+        for i in range(movies):
+            record = {'wikidata_id': movie_ids[i],
+                      'label': 'Movie {}'.format(i),
+                      'imdb_id': 'tt{:07d}'.format(i),
+                      'rotten_tomatoes_id': 'm/movie_{}'.format(i),
+                      'enwiki_title': 'Movie {}'.format(i),
+                      'genre': genre_lists[i],
+                      'director': director_lists[i],
+                      'cast_member': cast_lists[i],
+                      'publication_date': dates[i],
+                      'country_of_origin': 'Q30',
+                      'original_language': 'Q1860'}
+            if with_return[i]:
+                record.update(nbox=float(box_office[i]), ncost=float(cost[i]),
+                              made_profit=bool(box_office[i] > cost[i]))
+                record['return'] = round(float(box_office[i] / cost[i]), 1)
+            yield record
+
+    columns = {'audience_average': scores(rng, movies, 3.4, 0.5, 0.5, 5, 1),
+               'audience_percent': scores(rng, movies, 60, 20, 0, 100),
+               'audience_ratings': np.round(10 ** rng.uniform(1, 7, movies)),
+               'critic_average': scores(rng, movies, 6, 1.5, 0, 10, 1),
+               'critic_percent': scores(rng, movies, 60, 28, 0, 100)}
+
+    def rt_records():
+        for i in range(movies):
+            record = {name: _number(values[i])
+                      for name, values in columns.items()}
+            record.update(imdb_id='tt{:07d}'.format(i),
+                          rotten_tomatoes_id='m/movie_{}'.format(i))
+            yield record
+
+    def label_records(ids, column, name):
+        for i, wikidata_id in enumerate(ids):
+            yield {'wikidata_id': wikidata_id,
+                   column: '{} {}'.format(name, i)}
+
+    file = path.join(directory, '{}.json.gz')
+    write_json_gz(movie_records(), file.format('wikidata-movies'))
+    write_json_gz(rt_records(), file.format('rotten-tomatoes'))
+    write_json_gz(label_records(genre_ids, 'genre_label', 'genre'),
+                  file.format('genre'))
+    write_json_gz(label_records(cast_ids, 'name', 'actor'),
+                  file.format('cast_member'))
+    write_json_gz(label_records(director_ids, 'name', 'director'),
+                  file.format('director'))
+    return {'wikidata-movies': movies, 'rotten-tomatoes': movies,
+            'genre': genres, 'cast_member': people, 'director': directors}
@@ -3,17 +3,16 @@ Written by ggbaker
 """
 
 import sys
-from pyspark.sql import SparkSession, functions, types
+import argparse
+import glob
+import gzip
 import json
-
-spark = SparkSession.builder \
-    .appName('wikidata data extractor') \
-    .getOrCreate()
+import os
+import re
+from collections import Counter
+from multiprocessing import Pool
 
 assert sys.version_info >= (3, 5) # make sure we have Python 3.5+
-assert spark.version >= '2.1' # make sure we have Spark 2.1+
-
-sc = spark.sparkContext
 
 interesting_claims = {
     'P31': 'instance_of',
@@ -96,8 +95,16 @@ def to_useful_data(e):
     return data
 
 
-def main():
-    lines = sc.textFile(sys.argv[1])
+def spark_main(inputs, output):
+    from pyspark.sql import SparkSession
+
+    spark = SparkSession.builder \
+        .appName('wikidata data extractor') \
+        .getOrCreate()
+    assert spark.version >= '2.1' # make sure we have Spark 2.1+
+    sc = spark.sparkContext
+
+    lines = sc.textFile(inputs)
     lines = lines.filter(lambda l: len(l) > 1) # throw away initial '[' and ']' lines
     lines = lines.map(no_trailing_comma)
     entities = lines.map(json.loads)
@@ -105,11 +112,269 @@ def main():
     useful_data = entities.map(to_useful_data)
     useful_data = useful_data.map(json.dumps)
     # output as by-line JSON data that Spark SQL can deal with.
-    useful_data.saveAsTextFile(sys.argv[2], compressionCodecClass='org.apache.hadoop.io.compress.GzipCodec')
+    useful_data.saveAsTextFile(output, compressionCodecClass='org.apache.hadoop.io.compress.GzipCodec')
 
     # read it back and make the parquet version of the data while we're here...
-    wd = spark.read.json(sys.argv[2])
-    wd.write.parquet(sys.argv[2] + '-parquet', mode='overwrite', compression='gzip')
+    wd = spark.read.json(output)
+    wd.write.parquet(output + '-parquet', mode='overwrite', compression='gzip')
+
+
+# a film has both of these properties; the dump keeps the property ids as
+# keys of 'claims', so their quoted form is in the line of every film
+FILM_KEYS = ('"P345"', '"P1258"')
+# the entity id is the first "id" of every line of the dump
+ENTITY_ID = re.compile(r'"id"\s*:\s*"([^"]+)"')
+DECODERS = ['orjson', 'simdjson', 'json']
+
+_decoders = {}
+_referenced = set()
+
+
+def get_decoder(name='auto'):
+    """
+    json.loads compatible function for the dump lines. 'auto' uses the fastest
+    installed of DECODERS
+    :param name: String, 'auto' or one of DECODERS
+    :return: function, string to decoded json
+    """
+    if name not in _decoders:
+        names = DECODERS if name == 'auto' else [name]
+        for n in names:
+            try:
+                _decoders[name] = __import__(n).loads
+                break
+            except ImportError:
+                if name != 'auto':
+                    raise
+    return _decoders[name]
+
+
+def is_film(l):
+    """
+    Cheap check, without parsing, that a line can be a film with an IMDb and
+    Rotten Tomatoes id
+    """
+    return all(k in l for k in FILM_KEYS)
+
+
+def referenced_ids(data):
+    """
+    All the entity ids that a film's useful data refers to (genres, people,
+    ...), whose labels are needed by build_wikidata_movies.py
+    """
+    ids = set()
+    for p, name in interesting_claims.items():
+        for v in data.get(name, ()):
+            if isinstance(v, str) and v.startswith('Q'):
+                ids.add(v)
+    return ids
+
+
+def read_entities(infile, counts, keep=None):
+    """
+    Stream the lines of a chunk of the dump, throwing away the initial '['
+    and ']' lines and the trailing commas
+    :param infile: String, path of the gzip chunk
+    :param counts: Counter, gets the number of 'scanned' and 'skipped' lines
+    :param keep: function, cheap test on the raw line: lines failing it are
+    skipped without being parsed
+    :return: generator of lines to parse
+    """
+    with gzip.open(infile, 'rt', encoding='utf-8') as lines:
+        for l in lines:
+            l = l.rstrip('\n')
+            if len(l) <= 1:
+                continue
+            counts['scanned'] += 1
+            if keep is not None and not keep(l):
+                counts['skipped'] += 1
+                continue
+            yield no_trailing_comma(l)
+
+
+def write_entities(outfile, entities, counts, decoder):
+    """
+    Parse and convert lines with to_useful_data, writing by-line JSON like
+    saveAsTextFile. The file only appears once it is complete
+    :param outfile: String, path of the gzip output
+    :param entities: iterable of lines to parse
+    :param counts: Counter, gets the number of 'parsed' lines
+    :param decoder: String, name for get_decoder
+    :return: generator of the useful data written (consume it to write)
+    """
+    loads = get_decoder(decoder)
+    tmp = outfile + '.tmp'
+    with gzip.open(tmp, 'wt', encoding='utf-8') as out:
+        for l in entities:
+            counts['parsed'] += 1
+            data = to_useful_data(loads(l))
+            out.write(json.dumps(data))
+            out.write('\n')
+            yield data
+    os.replace(tmp, outfile)
+
+
+def transform_file(task):
+    """
+    Stream one chunk of the dump: the same steps as spark_main, one line at a
+    time, so memory use doesn't depend on the size of the chunk
+    :param task: tuple, (path of the gzip chunk, path of the gzip output,
+    decoder name)
+    :return: tuple, (input path, Counter of scanned/skipped/parsed lines,
+    set of referenced ids)
+    """
+    infile, outfile, decoder = task
+    counts = Counter()
+    for _ in write_entities(outfile, read_entities(infile, counts), counts,
+                            decoder):
+        pass
+    return infile, counts, set()
+
+
+def transform_films(task):
+    """
+    First pass of the films only mode: only the lines that look like films
+    are parsed and written
+    :param task: same as transform_file
+    :return: same as transform_file, with the ids the films refer to
+    """
+    infile, outfile, decoder = task
+    counts = Counter()
+    referenced = set()
+    for data in write_entities(outfile,
+                               read_entities(infile, counts, is_film),
+                               counts, decoder):
+        referenced |= referenced_ids(data)
+    return infile, counts, referenced
+
+
+def is_referenced(l):
+    """
+    Cheap check that a line (that isn't a film, those are already written) is
+    an entity referred to by a film
+    """
+    if is_film(l):
+        return False
+    match = ENTITY_ID.search(l, 0, 200)
+    return match is not None and match.group(1) in _referenced
+
+
+def set_referenced(referenced):
+    global _referenced
+    _referenced = referenced
+
+
+def transform_referenced(task):
+    """
+    Second pass of the films only mode: only the entities referred to by the
+    films are parsed and written, for their labels
+    :param task: same as transform_file
+    :return: same as transform_file
+    """
+    infile, outfile, decoder = task
+    counts = Counter()
+    for _ in write_entities(outfile,
+                            read_entities(infile, counts, is_referenced),
+                            counts, decoder):
+        pass
+    return infile, counts, set()
+
+
+def run_pass(pool, function, tasks):
+    """
+    Run a pass over every chunk, printing the counters of each
+    :return: tuple, (total Counter, union of the referenced ids)
+    """
+    total = Counter()
+    referenced = set()
+    for infile, counts, ids in pool.imap_unordered(function, tasks):
+        print(json.dumps(dict(counts, file=infile)))
+        total.update(counts)
+        referenced |= ids
+    return total, referenced
+
+
+def list_inputs(inputs):
+    """
+    Expand directories into the (non hidden) files in them, like sc.textFile
+    :param inputs: List, files and directories
+    :return: List, sorted files
+    """
+    files = []
+    for i in inputs:
+        if os.path.isdir(i):
+            files += [f for f in glob.glob(os.path.join(i, '*'))
+                      if os.path.isfile(f)]
+        else:
+            files += glob.glob(i)
+    return sorted(files)
+
+
+def local_main(inputs, output, jobs, decoder='auto', films_only=False):
+    """
+    Same output as spark_main's by-line JSON without Spark: one worker per
+    chunk made by split-wikidata.sh, each writing its own part-NNNNN.gz in
+    the output directory. Read it in Spark with spark.read.json(output)
+
+    With films_only, the lines are checked for FILM_KEYS before parsing and
+    only films are kept, plus (in a second pass) the entities they refer to,
+    so build_wikidata_movies.py still finds every label it needs
+    :param inputs: List, gzip chunks of the dump (or directories of them)
+    :param output: String, output directory
+    :param jobs: int, number of worker processes
+    :param decoder: String, json decoder (see get_decoder)
+    :param films_only: bool, skip the entities films don't need
+    """
+    files = list_inputs(inputs)
+    if not files:
+        raise ValueError('no input files in {}'.format(inputs))
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    get_decoder(decoder)  # fail early if it isn't installed
+
+    def tasks(suffix=''):
+        return [(f, os.path.join(output, 'part-{:05d}{}.gz'.format(i, suffix)),
+                 decoder)
+                for i, f in enumerate(files)]
+
+    with Pool(jobs) as pool:
+        if films_only:
+            total, referenced = run_pass(pool, transform_films, tasks())
+        else:
+            total, referenced = run_pass(pool, transform_file, tasks())
+    if films_only:
+        with Pool(jobs, set_referenced, (referenced,)) as pool:
+            total.update(run_pass(pool, transform_referenced,
+                                  tasks('-referenced'))[0])
+    print(json.dumps(dict(total, file='total')))
+    # mark the output complete, as Spark does
+    open(os.path.join(output, '_SUCCESS'), 'w').close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='+',
+                        help="wikidata dump (chunks from split-wikidata.sh)")
+    parser.add_argument('output', help="output directory")
+    parser.add_argument('--local', action='store_true',
+                        help="Run without Spark, streaming every chunk")
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                        help="Number of worker processes in local mode")
+    parser.add_argument('--decoder', default='auto',
+                        choices=['auto'] + DECODERS,
+                        help="JSON decoder in local mode (auto: fastest "
+                             "installed)")
+    parser.add_argument('--films-only', action='store_true',
+                        help="In local mode, only keep films and the entities "
+                             "they refer to, skipping the rest before parsing")
+    args = parser.parse_args()
+
+    if args.local:
+        local_main(args.inputs, args.output, args.jobs, args.decoder,
+                   args.films_only)
+    else:
+        spark_main(','.join(args.inputs), args.output)
 
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
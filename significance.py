@@ -0,0 +1,285 @@
+"""
+One-way ANOVA and Tukey's HSD for comparison.py, computed from the statistics
+of every group (number of movies, mean and sum of squared deviations) instead
+of from the rows themselves, so memory grows with the number of groups only.
+The results match scipy's f_oneway and statsmodels' pairwise_tukeyhsd.
+
+For skewed scores (eg return) there are resampling versions that don't assume
+normal groups: bootstrap intervals of the group means and a permutation test
+of the ANOVA. Resamples are drawn in batches, a chunk of CHUNK_RESAMPLES at a
+time with its own seed, so the results only depend on the seed, not on the
+number of processes used.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import special
+
+from data import profiling
+
+AnovaResult = namedtuple('AnovaResult', ['statistic', 'pvalue'])
+
+RESAMPLES = 10000
+CHUNK_RESAMPLES = 500
+# values drawn at once in a batch of resamples
+BATCH_VALUES = 1 << 22
+
+
+def studentized_range():
+    """
+    Imported when a Tukey HSD is needed: scipy.stats takes longer to load
+    than everything else comparison.py needs
+    :return: tuple, (ppf, sf) of the studentized range distribution
+    """
+    try:
+        from scipy.stats import studentized_range
+        return studentized_range.ppf, studentized_range.sf
+    except ImportError:
+        # scipy < 1.7: statsmodels' tables, which pairwise_tukeyhsd uses too
+        from statsmodels.stats.libqsturng import psturng, qsturng
+        return qsturng, psturng
+
+
+@profiling.stage('group_stats')
+def group_stats(values, groups):
+    """
+    Sufficient statistics of every group, in a single pass over the rows.
+    Rows without a group are left out, as in a groupby
+    :param values: array, score of every row
+    :param groups: array, group of every row
+    :return: Dataframe, indexed by the sorted groups: n, mean and ss (sum of
+    squared deviations from the mean)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    codes, names = pd.factorize(np.asarray(groups), sort=True)
+    values = values[codes >= 0]
+    codes = codes[codes >= 0]
+    n = np.bincount(codes, minlength=len(names))
+    mean = np.bincount(codes, values, minlength=len(names)) / n
+    ss = np.bincount(codes, (values - mean[codes]) ** 2, minlength=len(names))
+    return pd.DataFrame({'n': n, 'mean': mean, 'ss': ss},
+                        index=pd.Index(names))
+
+
+def pooled_variance(stats):
+    """
+    :param stats: Dataframe, from group_stats
+    :return: tuple, (variance within the groups, its degrees of freedom)
+    """
+    df = stats['n'].sum() - len(stats)
+    return stats['ss'].sum() / df, df
+
+
+@profiling.stage('anova')
+def anova(stats):
+    """
+    One-way ANOVA of the groups
+    :param stats: Dataframe, from group_stats
+    :return: AnovaResult, F statistic and p value (as stats.f_oneway)
+    """
+    n = stats['n'].values
+    mean = stats['mean'].values
+    grand_mean = (n * mean).sum() / n.sum()
+    between = (n * (mean - grand_mean) ** 2).sum() / (len(stats) - 1)
+    within, df = pooled_variance(stats)
+    statistic = between / within
+    return AnovaResult(statistic,
+                       special.fdtrc(len(stats) - 1, df, statistic))
+
+
+def simultaneous_halfwidths(stats, q_crit, variance):
+    """
+    Half widths of the simultaneous confidence interval of every group mean
+    (Hochberg and Tamhane): two groups differ when their intervals don't
+    overlap. Same as statsmodels' simultaneous_ci
+    :param stats: Dataframe, from group_stats
+    :param q_crit: float, critical value of the studentized range
+    :param variance: float, pooled variance
+    :return: array, half width of each group's interval
+    """
+    k = len(stats)
+    group_variance = variance / stats['n'].values
+    d = np.sqrt(group_variance[:, None] + group_variance[None, :])
+    np.fill_diagonal(d, 0)
+    total = d.sum() / 2
+    if k > 2:
+        w = ((k - 1.0) * d.sum(axis=0) - total) / ((k - 1.0) * (k - 2.0))
+    else:
+        w = np.full(k, total / 2.0)
+    return q_crit / np.sqrt(2) * w
+
+
+@profiling.stage('tukey_hsd')
+def tukey_hsd(stats, alpha=0.05, pairs=True, pvalues=True):
+    """
+    Tukey's honestly significant difference test of every pair of groups
+    :param stats: Dataframe, from group_stats
+    :param alpha: float, family-wise error rate
+    :param pairs: bool, compute the pairwise comparisons. Without them, only
+    the simultaneous intervals (what plot_simultaneous needs) are computed
+    :param pvalues: bool, compute the adjusted p values of the pairs (by far
+    the slowest part with many groups)
+    :return: dict, q_crit, variance, df, halfwidths and, with pairs, a
+    Dataframe of the pairs: group1, group2, meandiff, p-adj, lower, upper and
+    reject, in the order of pairwise_tukeyhsd
+    """
+    qcrit, range_pvalue = studentized_range()
+    k = len(stats)
+    variance, df = pooled_variance(stats)
+    q_crit = qcrit(1 - alpha, k, df)
+    result = {'q_crit': q_crit, 'variance': variance, 'df': df,
+              'halfwidths': simultaneous_halfwidths(stats, q_crit, variance)}
+    if not pairs:
+        return result
+
+    names = stats.index.values
+    n = stats['n'].values
+    mean = stats['mean'].values
+    first, second = np.triu_indices(k, 1)
+    meandiff = mean[second] - mean[first]
+    std = np.sqrt(variance * (1.0 / n[first] + 1.0 / n[second]) / 2.0)
+    st_range = np.abs(meandiff) / std
+    crit = std * q_crit
+    result['pairs'] = pd.DataFrame({
+        'group1': names[first],
+        'group2': names[second],
+        'meandiff': meandiff,
+        'p-adj': (range_pvalue(st_range, k, df) if pvalues
+                  else np.nan),
+        'lower': meandiff - crit,
+        'upper': meandiff + crit,
+        'reject': st_range > q_crit,
+    }, columns=['group1', 'group2', 'meandiff', 'p-adj', 'lower', 'upper',
+                'reject'])
+    return result
+
+
+def _sort_by_group(values, groups):
+    """
+    Order the values group by group, so the sums of a group are one
+    np.add.reduceat
+    :return: tuple, (sorted values, start of each group, n of each group,
+    group names)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    codes, names = pd.factorize(np.asarray(groups), sort=True)
+    keep = codes >= 0
+    codes = codes[keep]
+    order = np.argsort(codes, kind='mergesort')
+    n = np.bincount(codes, minlength=len(names))
+    starts = np.zeros(len(names), dtype=np.int64)
+    np.cumsum(n[:-1], out=starts[1:])
+    return values[keep][order], starts, n, names
+
+
+def _batches(resamples, size):
+    rows = max(1, BATCH_VALUES // max(1, size))
+    for start in range(0, resamples, rows):
+        yield min(rows, resamples - start)
+
+
+def _bootstrap_chunk(task):
+    """
+    Means of every group in 'resamples' bootstrap resamples, each group
+    resampled with replacement within itself
+    :return: array, (resamples, groups)
+    """
+    values, starts, n, resamples, seed = task
+    random = np.random.RandomState(seed)
+    first = np.repeat(starts, n)
+    size = np.repeat(n, n)
+    means = []
+    for rows in _batches(resamples, len(values)):
+        picks = first + (random.random_sample((rows, len(values))) *
+                         size).astype(np.int64)
+        means.append(np.add.reduceat(values[picks], starts, axis=1) / n)
+    return np.concatenate(means)
+
+
+def _between_groups(values, starts, n):
+    """
+    Sum over the groups of n * mean ** 2: with the total fixed, the ANOVA's F
+    grows with it, so permutations can be compared on it alone
+    """
+    sums = np.add.reduceat(values, starts, axis=-1)
+    return (sums ** 2 / n).sum(axis=-1)
+
+
+def _permutation_chunk(task):
+    """
+    _between_groups of 'resamples' random reassignments of the values to the
+    groups (keeping their sizes)
+    :return: array, (resamples,)
+    """
+    values, starts, n, resamples, seed = task
+    random = np.random.RandomState(seed)
+    statistics = []
+    for rows in _batches(resamples, len(values)):
+        permutations = random.random_sample((rows, len(values))).argsort(axis=1)
+        statistics.append(_between_groups(values[permutations], starts, n))
+    return np.concatenate(statistics)
+
+
+def _resample(function, values, starts, n, resamples, seed, jobs):
+    """
+    Run 'function' over the resamples, CHUNK_RESAMPLES at a time, in 'jobs'
+    processes
+    """
+    tasks = [(values, starts, n, min(CHUNK_RESAMPLES, resamples - start),
+              [seed, chunk])
+             for chunk, start in enumerate(range(0, resamples,
+                                                 CHUNK_RESAMPLES))]
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            return np.concatenate(list(pool.map(function, tasks)))
+    return np.concatenate([function(task) for task in tasks])
+
+
+@profiling.stage('bootstrap_ci')
+def bootstrap_ci(values, groups, alpha=0.05, resamples=RESAMPLES, seed=0,
+                 jobs=1):
+    """
+    Percentile bootstrap confidence interval of the mean of every group
+    :param values: array, score of every row
+    :param groups: array, group of every row
+    :param alpha: float, 1 - confidence level
+    :param resamples: int, number of bootstrap resamples
+    :param seed: int, seed of the random numbers
+    :param jobs: int, number of processes
+    :return: Dataframe, indexed by the sorted groups: n, mean, lower, upper
+    """
+    values, starts, n, names = _sort_by_group(values, groups)
+    means = _resample(_bootstrap_chunk, values, starts, n, resamples, seed,
+                      jobs)
+    lower, upper = np.percentile(means, [100 * alpha / 2,
+                                         100 * (1 - alpha / 2)], axis=0)
+    return pd.DataFrame({'n': n,
+                         'mean': np.add.reduceat(values, starts) / n,
+                         'lower': lower, 'upper': upper},
+                        index=pd.Index(names),
+                        columns=['n', 'mean', 'lower', 'upper'])
+
+
+@profiling.stage('permutation_anova')
+def permutation_anova(values, groups, resamples=RESAMPLES, seed=0, jobs=1):
+    """
+    One-way ANOVA with the p value of a permutation test: the share of random
+    reassignments of the values to the groups that separate the group means
+    at least as much as the real groups
+    :param values: array, score of every row
+    :param groups: array, group of every row
+    :param resamples: int, number of permutations
+    :param seed: int, seed of the random numbers
+    :param jobs: int, number of processes
+    :return: AnovaResult, F statistic and permutation p value
+    """
+    statistic = anova(group_stats(values, groups)).statistic
+    values, starts, n, names = _sort_by_group(values, groups)
+    observed = _between_groups(values, starts, n)
+    permuted = _resample(_permutation_chunk, values, starts, n, resamples,
+                         seed, jobs)
+    # allow for rounding: a permutation of the observed groups is as extreme
+    extreme = (permuted >= observed * (1 - 1e-12)).sum()
+    return AnovaResult(statistic, (extreme + 1.0) / (resamples + 1.0))
@@ -0,0 +1,200 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import comparison
+import yearly
+from data import profiling
+
+parser = argparse.ArgumentParser(
+    description="Run comparison.py and yearly.py over every combination of "
+                "the parameters, loading the movie data once")
+parser.add_argument("--config", type=str,
+                    help="JSON file with the lists of parameters to sweep "
+                         "(same keys as the long options below)",
+                    default=None)
+parser.add_argument("--category", "-c", type=str, nargs='+',
+                    help="Properties to focus on",
+                    choices=['genre', 'cast_member', 'director'],
+                    default=['genre'])
+parser.add_argument("--score", "-s", type=str, nargs='+',
+                    help="Scores to focus on",
+                    choices=['return', 'critic_percent', 'critic_average',
+                             'audience_percent', 'audience_average'],
+                    default=['critic_percent'])
+parser.add_argument("--movies", "-m", type=int, nargs='+',
+                    help="Minimum numbers of movies of each property",
+                    default=[40])
+parser.add_argument("--influencers", "-i", type=int, nargs='+',
+                    help="Numbers of influential people/genres",
+                    default=[25])
+parser.add_argument("--year", "-y", type=int, nargs=2, action='append',
+                    help="Bound the publication dates by the years (can be "
+                         "given more than once)",
+                    default=None)
+parser.add_argument("--width", "-w", type=int,
+                    help="Number of years averaged together in the yearly "
+                         "plots",
+                    default=10)
+parser.add_argument("--plots", "-p", type=str, nargs='+',
+                    help="Figures to produce",
+                    choices=['comparison', 'yearly'],
+                    default=['comparison', 'yearly'])
+parser.add_argument("--jobs", "-j", type=int,
+                    help="Number of processes to run configurations in",
+                    default=1)
+parser.add_argument("--no-cache", action='store_true',
+                    help="Don't read or write the cached movie data")
+parser.add_argument("--refresh", action='store_true',
+                    help="Rebuild the cached movie data")
+parser.add_argument("--exact", action='store_true',
+                    help="Find the most influential from the full movie table "
+                         "instead of the aggregate index")
+parser.add_argument("--resample", "-r", type=int,
+                    help="Use a permutation test and bootstrap intervals with "
+                         "this many resamples in the comparisons",
+                    default=0)
+parser.add_argument("--seed", type=int,
+                    help="Seed of the resampling",
+                    default=0)
+parser.add_argument("--timings", type=str,
+                    help="Save the wall time, rows in/out and peak memory of "
+                         "each stage of every configuration in this JSON file "
+                         "('-' to print them)",
+                    default=None)
+parser.add_argument("--profile", type=str,
+                    help="Save a cProfile dump of the sweep in this file "
+                         "(pyinstrument's report if it ends with .html). Only "
+                         "covers the configurations run in the main process "
+                         "(--jobs 1)",
+                    default=None)
+
+GRID_KEYS = ['category', 'score', 'movies', 'influencers', 'year']
+
+
+def read_config(args):
+    """
+    Replace the command line lists by the ones in the config file, if any
+    :param args: Namespace, command line arguments
+    :return: Namespace, arguments with the config applied
+    """
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        for key, value in config.items():
+            key = key.replace('-', '_')
+            if not hasattr(args, key):
+                raise ValueError('unknown config key: {}'.format(key))
+            setattr(args, key, value)
+    return args
+
+
+def make_grid(args):
+    """
+    Every combination of the swept parameters. Combinations with the same
+    category and score are kept together so they share the loaded data
+    :param args: Namespace, sweep arguments
+    :return: List of Namespace, one per configuration
+    """
+    years = args.year or [None]
+    grid = []
+    for values in itertools.product(args.category, args.score, args.movies,
+                                    args.influencers, years):
+        config = dict(zip(GRID_KEYS, values))
+        config.update(no_cache=args.no_cache, refresh=args.refresh,
+                      exact=args.exact, resample=args.resample,
+                      seed=args.seed, width=args.width)
+        grid.append(argparse.Namespace(**config))
+    return grid
+
+
+def run_config(config, plots, timings=False):
+    """
+    Produce the figures of one configuration
+    :param config: Namespace, same arguments as comparison.py/yearly.py
+    :param plots: List, figures to produce ('comparison', 'yearly')
+    :param timings: bool, record the stages of the configuration
+    :return: tuple, (file name, p value of the ANOVA or None, records of the
+    stages or None)
+    """
+    import data.data as dm
+
+    if timings:
+        profiling.enable()
+    data = dm.get_movie_data(config)
+    pvalue = None
+    if 'comparison' in plots:
+        pvalue = comparison.compare(data, config,
+                                    comparison.get_filename(config))
+    if 'yearly' in plots:
+        yearly.plot_yearly(data, config, yearly.get_filename(config))
+    stages = None
+    if timings:
+        profiling.disable()
+        stages = profiling.collect()
+    return comparison.get_filename(config), pvalue, stages
+
+
+def prepare_grid(grid):
+    """
+    Load and prepare the data of every (category, score) of the grid in the
+    default session: the coded wikidata, the labels and, unless the
+    configurations are exact, the aggregate index (which also goes to the
+    result cache). Workers forked afterwards share it instead of each
+    preparing it again
+    :param grid: List of Namespace, as returned by make_grid
+    """
+    import data.data as dm
+
+    session = dm.default_session()
+    prepared = set()
+    for config in grid:
+        if (config.category, config.score) in prepared:
+            continue
+        prepared.add((config.category, config.score))
+        session.prepped(config.category, config.score)
+        session.labels(config.category)
+        if not config.exact:
+            session.category_index(config.category, config.score,
+                                   config.refresh, not config.no_cache)
+
+
+def main(args=None):
+    if args is None:
+        args = parser.parse_args()
+    args = read_config(args)
+    grid = make_grid(args)
+    print("Running {} configurations".format(len(grid)))
+
+    timings = bool(args.timings)
+    with profiling.profiled(args.profile):
+        if args.jobs > 1:
+            # workers forked after the preparation share the parent's data
+            # and only run the queries, so one (category, score) still uses
+            # every worker
+            prepare_grid(grid)
+            context = (multiprocessing.get_context('fork')
+                       if 'fork' in multiprocessing.get_all_start_methods()
+                       else None)
+            with ProcessPoolExecutor(max_workers=args.jobs,
+                                     mp_context=context) as pool:
+                results = list(pool.map(run_config, grid,
+                                        itertools.repeat(args.plots),
+                                        itertools.repeat(timings)))
+        else:
+            results = [run_config(config, args.plots, timings)
+                       for config in grid]
+
+    for filename, pvalue, _ in results:
+        print("{}: p value {}".format(filename, pvalue))
+    if timings:
+        profiling.write_json([{'config': vars(config), 'stages': stages}
+                              for config, (_, _, stages) in zip(grid, results)],
+                             args.timings)
+    print("Sweep Done")
+
+
+if __name__ == '__main__':
+    main()
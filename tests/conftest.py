@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# the scripts and the data package are imported from the repository root
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
@@ -0,0 +1,53 @@
+"""
+The aggregate index must rank people/genres exactly like the full movie
+table (--exact), ties included.
+"""
+from os import path
+
+import pytest
+
+import data.data as dm
+from data import columnar, synthetic
+
+
+@pytest.fixture(scope='module')
+def session(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('movies')
+    synthetic.generate(str(folder), movies=2000, genres=40, seed=1)
+    cache = pytest.MonkeyPatch()
+    # the columnar copies of the synthetic files stay out of data/cache
+    cache.setattr(columnar, 'CACHE_PATH', str(folder / 'cache'))
+    yield dm.MovieSession(path.join(str(folder), '{}.json.gz'), False)
+    cache.undo()
+
+
+@pytest.mark.parametrize('category, score, min_movies, n, years', [
+    ('cast_member', 'critic_percent', 2, 300, None),
+    ('director', 'critic_percent', 2, 50, None),
+    ('director', 'audience_average', 1, 200, [1950, 2000]),
+    ('cast_member', 'critic_average', 3, 100, None),
+    ('cast_member', 'return', 1, 40, [1980, 2020]),
+])
+def test_index_ranks_like_exact(session, category, score, min_movies, n,
+                                years):
+    exact = session.top_entities(category, score, min_movies, n, years,
+                                 exact=True)
+    index = session.top_entities(category, score, min_movies, n, years)
+    assert len(index) == min(n, len(exact)) and len(index)
+    assert list(index['wikidata_id']) == list(exact['wikidata_id'])
+    assert list(index['movies']) == list(exact['movies'])
+    # the ranking has ties, broken by wikidata id
+    assert exact[score].round(dm.RANK_DECIMALS).duplicated().any()
+
+
+def test_session_keeps_the_last_results(session):
+    small = dm.MovieSession(session.json_path, False, max_results=2)
+    first = small.filtered_movies('genre', 'critic_percent', 5, 5)
+    small.filtered_movies('genre', 'critic_percent', 5, 10)
+    assert small.filtered_movies('genre', 'critic_percent', 5, 5) is first
+    small.filtered_movies('genre', 'critic_percent', 5, 20)
+    assert len(small._results) == 2
+    # the query used least recently was dropped, the others are kept
+    assert small.filtered_movies('genre', 'critic_percent', 5, 5) is first
+    small.clear()
+    assert not small._results and not small._tables
@@ -0,0 +1,138 @@
+"""
+fetch_all against a local stand-in for the OMDb API: retries, the request
+limit and resuming from the SQLite cache.
+"""
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytest.importorskip('requests')
+# get_omdb_data is run from data/ and imports omdb_cache from there. The
+# folder is only on the path for the import: data/data.py would hide the
+# data package
+sys.path.insert(0, path.join(path.dirname(path.dirname(
+    path.abspath(__file__))), 'data'))
+try:
+    import get_omdb_data
+    import omdb_cache
+finally:
+    del sys.path[0]
+
+# fast enough for CI, the retries still wait
+BACKOFF = 0.01
+
+
+def movie(imdb_id):
+    return {'Response': 'True', 'imdbID': imdb_id, 'Genre': 'Drama',
+            'Plot': 'Plot of {}'.format(imdb_id), 'Awards': 'N/A'}
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Answers every IMDb ID with a movie, after the responses scripted for it.
+    Once 'limit' movies are served, answers with the request limit error
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.scripts = {}
+        self.requests = []
+        self.limit = None
+
+    def respond(self, imdb_id):
+        """
+        :return: tuple, (HTTP status, json body)
+        """
+        with self.lock:
+            self.requests.append(imdb_id)
+            script = self.scripts.get(imdb_id)
+            if script:
+                return script.pop(0)
+            if self.limit is not None:
+                if self.limit <= 0:
+                    return 401, {'Response': 'False',
+                                 'Error': get_omdb_data.REQUEST_LIMIT}
+                self.limit -= 1
+            return 200, movie(imdb_id)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        imdb_id = parse_qs(urlparse(self.path).query)['i'][0]
+        status, body = self.server.respond(imdb_id)
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = omdb_cache.open_cache(str(tmp_path / 'omdb.sqlite'))
+    yield db
+    db.close()
+
+
+def fetch(server, db, imdb_ids, workers=2):
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    return get_omdb_data.fetch_all(imdb_ids, db, 'key', url, rate=1000,
+                                   workers=workers, backoff=BACKOFF)
+
+
+def test_unavailable_is_retried(server, db):
+    server.scripts['tt0000001'] = [(503, {}), (503, {})]
+    assert fetch(server, db, ['tt0000001']) == (1, False)
+    assert server.requests == ['tt0000001'] * 3
+    assert omdb_cache.get_many(db, ['tt0000001']) == {
+        'tt0000001': {'Genre': 'Drama', 'Plot': 'Plot of tt0000001',
+                      'Awards': 'N/A'}}
+
+
+def test_request_limit_stops_and_resumes(server, db):
+    imdb_ids = ['tt{:07d}'.format(i) for i in range(1, 7)]
+    server.limit = 2
+    fetched, limit_reached = fetch(server, db, imdb_ids)
+    assert (fetched, limit_reached) == (2, True)
+    first_run = omdb_cache.cached_ids(db)
+    assert len(first_run) == 2
+
+    server.limit = None
+    del server.requests[:]
+    assert fetch(server, db, imdb_ids) == (4, False)
+    assert sorted(server.requests) == sorted(set(imdb_ids) - first_run)
+    assert omdb_cache.cached_ids(db) == set(imdb_ids)
+
+
+def test_missing_movie_is_cached(server, db):
+    server.scripts['tt0000009'] = [
+        (200, {'Response': 'False', 'Error': 'Error getting data.'})]
+    assert fetch(server, db, ['tt0000009']) == (1, False)
+    assert omdb_cache.get_many(db, ['tt0000009']) == {
+        'tt0000009': omdb_cache.NOT_FOUND}
+
+    del server.requests[:]
+    assert fetch(server, db, ['tt0000009']) == (0, False)
+    assert server.requests == []
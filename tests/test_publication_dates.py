@@ -0,0 +1,90 @@
+"""
+Tricky wikidata dates through first_publication_date, against the strptime
+version it replaced.
+"""
+import datetime
+
+import pytest
+
+ISOFMT = '+%Y-%m-%dT%H:%M:%SZ'
+DATES = ['+2001-05-00T00:00:00Z',
+         '+2001-00-00T00:00:00Z',
+         '+2001-02-29T00:00:00Z',
+         '+2000-02-29T00:00:00Z',
+         '+1999-04-31T00:00:00Z',
+         '+1995-01-01T00:00:00Z',
+         '-0044-03-15T00:00:00Z']
+
+
+def strptime_date(d):
+    """
+    The old extract_isodate, except that dates strptime can't read at all
+    (BCE) are None instead of failing the job
+    """
+    try:
+        return datetime.datetime.strptime(d, ISOFMT).date()
+    except ValueError:
+        pass
+    try:
+        d0 = d[:9] + '01' + d[11:]
+        return datetime.datetime.strptime(d0, ISOFMT).date()
+    except ValueError:
+        pass
+    try:
+        d1 = d0[:6] + '01' + d0[8:]
+        return datetime.datetime.strptime(d1, ISOFMT).date()
+    except ValueError:
+        return None
+
+
+def earliest(dates):
+    if dates is None:
+        return None
+    dates = [d for d in map(strptime_date, dates) if d is not None]
+    return min(dates) if dates else None
+
+
+@pytest.fixture(scope='module')
+def build():
+    pytest.importorskip('pyspark')
+    from pyspark.sql import SparkSession
+    # created first, so the module reuses it instead of its cluster settings
+    spark = SparkSession.builder.master('local[1]') \
+        .appName('publication date tests').getOrCreate()
+    from data import build_wikidata_movies
+    yield build_wikidata_movies
+    spark.stop()
+
+
+def first_dates(build, arrays):
+    from pyspark.sql import types
+    schema = types.StructType([types.StructField(
+        'publication_date', types.ArrayType(types.StringType()))])
+    df = build.spark.createDataFrame([(a,) for a in arrays], schema)
+    rows = df.select(build.first_publication_date('publication_date')
+                     .alias('date')).collect()
+    return [row['date'] for row in rows]
+
+
+def test_single_dates(build):
+    assert first_dates(build, [[d] for d in DATES]) == \
+        [strptime_date(d) for d in DATES]
+
+
+def test_expected_values():
+    assert [strptime_date(d) for d in DATES] == [
+        datetime.date(2001, 5, 1), datetime.date(2001, 1, 1),
+        datetime.date(2001, 2, 1), datetime.date(2000, 2, 29),
+        datetime.date(1999, 4, 1), datetime.date(1995, 1, 1), None]
+
+
+def test_mixed_and_null_arrays(build):
+    arrays = [['+2010-06-15T00:00:00Z', '+2001-00-00T00:00:00Z'],
+              ['+2001-05-00T00:00:00Z', '+1999-04-31T00:00:00Z',
+               '-0044-03-15T00:00:00Z'],
+              ['-0044-03-15T00:00:00Z'],
+              None]
+    assert first_dates(build, arrays) == [earliest(a) for a in arrays]
+    assert first_dates(build, arrays) == [datetime.date(2001, 1, 1),
+                                          datetime.date(1999, 4, 1),
+                                          None, None]
@@ -0,0 +1,104 @@
+"""
+significance.py must give the same results as the libraries it replaces:
+scipy's f_oneway and statsmodels' pairwise_tukeyhsd.
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats as scipy_stats
+
+import comparison
+import significance
+
+
+@pytest.fixture(scope='module')
+def multicomp():
+    return pytest.importorskip('statsmodels.stats.multicomp')
+
+
+def random_groups(seed, k):
+    """
+    :return: tuple of arrays, (scores, group of each score) of k groups of
+    different sizes and means
+    """
+    rng = np.random.RandomState(seed)
+    sizes = rng.randint(3, 30, k)
+    groups = np.repeat(['group {:02d}'.format(i) for i in range(k)], sizes)
+    values = rng.normal(60, 20, sizes.sum()) + np.repeat(
+        rng.normal(0, 10, k), sizes)
+    return values, groups
+
+
+@pytest.mark.parametrize('seed, k', [(0, 2), (1, 2), (2, 3), (3, 5), (4, 12)])
+def test_tukey_hsd_matches_statsmodels(multicomp, seed, k):
+    values, groups = random_groups(seed, k)
+    expected = multicomp.pairwise_tukeyhsd(values, groups, alpha=0.05)
+    expected._simultaneous_ci()
+
+    result = significance.tukey_hsd(significance.group_stats(values, groups),
+                                    alpha=0.05)
+    pairs = result['pairs']
+    first, second = np.triu_indices(k, 1)
+    names = expected.groupsunique
+    assert list(pairs['group1']) == list(names[first])
+    assert list(pairs['group2']) == list(names[second])
+    np.testing.assert_allclose(pairs['meandiff'], expected.meandiffs)
+    np.testing.assert_allclose(pairs['lower'], expected.confint[:, 0])
+    np.testing.assert_allclose(pairs['upper'], expected.confint[:, 1])
+    np.testing.assert_allclose(pairs['p-adj'], expected.pvalues, atol=1e-4)
+    assert list(pairs['reject']) == list(expected.reject)
+    assert result['q_crit'] == pytest.approx(expected.q_crit)
+    # statsmodels gives a column of half widths for 2 groups
+    np.testing.assert_allclose(result['halfwidths'],
+                               np.ravel(expected.halfwidths))
+
+
+def test_tukey_hsd_without_pvalues():
+    values, groups = random_groups(5, 6)
+    stats = significance.group_stats(values, groups)
+    full = significance.tukey_hsd(stats)
+    result = significance.tukey_hsd(stats, pvalues=False)
+    assert result['pairs']['p-adj'].isnull().all()
+    columns = ['group1', 'group2', 'meandiff', 'lower', 'upper', 'reject']
+    assert result['pairs'][columns].equals(full['pairs'][columns])
+    np.testing.assert_array_equal(result['halfwidths'], full['halfwidths'])
+
+
+def test_tukey_hsd_without_pairs():
+    values, groups = random_groups(6, 4)
+    stats = significance.group_stats(values, groups)
+    result = significance.tukey_hsd(stats, pairs=False)
+    assert 'pairs' not in result
+    np.testing.assert_array_equal(result['halfwidths'],
+                                  significance.tukey_hsd(stats)['halfwidths'])
+
+
+@pytest.mark.parametrize('seed, k', [(0, 2), (2, 3), (3, 5), (4, 12)])
+def test_anova_matches_f_oneway(seed, k):
+    values, groups = random_groups(seed, k)
+    expected = scipy_stats.f_oneway(*[values[groups == name]
+                                      for name in np.unique(groups)])
+    result = significance.anova(significance.group_stats(values, groups))
+    assert result.statistic == pytest.approx(expected.statistic)
+    assert result.pvalue == pytest.approx(expected.pvalue)
+
+
+def test_group_stats_drops_missing_groups():
+    values, groups = random_groups(7, 4)
+    groups = groups.astype(object)
+    groups[::5] = np.nan
+    stats = significance.group_stats(values, groups)
+    kept = pd.notnull(groups)
+    assert stats.equals(significance.group_stats(values[kept], groups[kept]))
+    assert stats['n'].sum() == kept.sum()
+
+
+def test_compare_needs_two_groups():
+    data = pd.DataFrame({'genre': ['drama'] * 5,
+                         'critic_percent': [50.0, 60, 70, 80, 90]})
+    args = argparse.Namespace(category='genre', score='critic_percent',
+                              movies=5, influencers=25, year=None,
+                              no_plot=True)
+    assert comparison.compare(data, args, 'unused') is None
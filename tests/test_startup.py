@@ -0,0 +1,36 @@
+"""
+Cold start budget of comparison.py and yearly.py: importing them or asking
+for --help must not load the heavy libraries.
+"""
+import subprocess
+import sys
+import time
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+# seconds for `comparison.py --help` in a new interpreter (measured: ~50ms)
+HELP_BUDGET = 0.5
+HEAVY_MODULES = ['pandas', 'matplotlib', 'scipy.stats', 'statsmodels',
+                 'seaborn']
+
+
+def run(*args):
+    return subprocess.run([sys.executable] + list(args), cwd=ROOT,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+
+
+def test_import_loads_no_heavy_library():
+    loaded = run('-c', 'import comparison, yearly, sys; '
+                       'print(" ".join(m for m in {!r} '
+                       'if m in sys.modules))'.format(HEAVY_MODULES))
+    assert loaded.stdout.split() == []
+
+
+def test_help_within_budget():
+    timings = []
+    for _ in range(3):
+        start = time.perf_counter()
+        run('comparison.py', '--help')
+        timings.append(time.perf_counter() - start)
+    assert min(timings) < HELP_BUDGET
@@ -1,8 +1,9 @@
-import matplotlib.pyplot as plt
-import data.data as dm
 import argparse
-import seaborn
-import math
+
+from data import profiling
+
+# the data, scipy and matplotlib are imported by the stages that need them,
+# so --help and --no-plot don't pay for them
 
 parser = argparse.ArgumentParser()
 
@@ -19,38 +20,139 @@ parser.add_argument("--movies", "-mo", type=int,
 parser.add_argument("--influencers", "-i", type=int,
                     help="Number of influential people/genres",
                     default=25)
+parser.add_argument("--year", "-y", type=int, nargs='+',
+                    help="Bound the publication dates by the years",
+                    default=None)
+parser.add_argument("--no-cache", action='store_true',
+                    help="Don't read or write the cached movie data")
+parser.add_argument("--refresh", action='store_true',
+                    help="Rebuild the cached movie data")
+parser.add_argument("--exact", action='store_true',
+                    help="Find the most influential from the full movie table "
+                         "instead of the aggregate index")
+parser.add_argument("--width", "-w", type=int,
+                    help="Number of years averaged together (10 for decades)",
+                    default=10)
+parser.add_argument("--no-plot", action='store_true',
+                    help="Only print the averages (without loading "
+                         "matplotlib)")
+parser.add_argument("--csv", type=str,
+                    help="Save the number of movies, average and interval of "
+                         "each person/genre and bin in this CSV file",
+                    default=None)
+parser.add_argument("--timings", type=str,
+                    help="Save the wall time, rows in/out and peak memory of "
+                         "each stage in this JSON file ('-' to print them)",
+                    default=None)
+parser.add_argument("--profile", type=str,
+                    help="Save a cProfile dump of the run in this file "
+                         "(pyinstrument's report if it ends with .html)",
+                    default=None)
 
-args = parser.parse_args()
+CONFIDENCE = 0.95
+# bins with fewer movies get no confidence band: it would be wider than the plot
+MIN_BAND_MOVIES = 5
 
-filename = '{}-{}-{}-{}'.format(args.category, args.score, args.movies,
-                                args.influencers)
+
+def get_filename(args):
+    """
+    Name of the figure, made of the parameters used
+    :param args: Namespace, command line arguments
+    :return: String, file name
+    """
+    filename = '{}-{}-{}-{}'.format(args.category, args.score, args.movies,
+                                    args.influencers)
+    if args.year:
+        filename += "-{}-{}".format(args.year[0], args.year[1])
+    width = getattr(args, 'width', 10)
+    if width != 10:
+        filename += "-every-{}".format(width)
+    return filename
 
 
-def get_decade(year):
+@profiling.stage('yearly_stats')
+def yearly_stats(data, category, score, width=10):
     """
-    Rounds the year to the decade
-    :param year: int, year of publication
-    :return: int, decade of movie
+    Number of movies, average score and its confidence interval of each
+    person/genre in every bin of 'width' years, from a single groupby
+    :param data: Dataframe, movie data from get_movie_data
+    :param category: String, column of the people/genres
+    :param score: String, column of the score
+    :param width: int, number of years in a bin (10 for decades)
+    :return: dict, 'count', 'mean', 'lower' and 'upper' Dataframes with one
+    row per bin (first year) and one column per person/genre, and the same
+    as one 'table' with a row per (person/genre, bin). None if no movie with
+    a publication date is left
     """
-    return int(math.floor(year / 10.0)) * 10
+    import numpy as np
+    from scipy import special
+    import data.data as dm
+
+    years = data['year'].values
+    has_year = years != dm.NO_YEAR
+    table = data[score][has_year].groupby(
+        [data[category].values[has_year],
+         dm.bin_years(years[has_year], width)]).agg(['count', 'mean', 'std'])
+    if table.empty:
+        print("No dated movies of the {}s to average".format(
+            category.replace("_", " ")))
+        return None
+    table.index.names = [category, 'year']
+    # t interval of the mean, NaN for bins of a single movie
+    halfwidth = (special.stdtrit(table['count'] - 1, (1 + CONFIDENCE) / 2) *
+                 table['std'] / np.sqrt(table['count']))
+    table['lower'] = table['mean'] - halfwidth
+    table['upper'] = table['mean'] + halfwidth
+    table = table.drop('std', axis=1)
+    matrix = table.unstack(level=0).sort_index()
+    return {'table': table,
+            'count': matrix['count'].fillna(0).astype(int),
+            'mean': matrix['mean'],
+            'lower': matrix['lower'], 'upper': matrix['upper']}
 
 
-def main():
+@profiling.stage('plot_yearly')
+def plot_yearly(data, args, filename):
+    """
+    Save the plot of the average score of each person/genre by decade (or
+    bins of args.width years) to figures/, with its confidence band
+    :param data: Dataframe, movie data from get_movie_data
+    :param args: Namespace, command line arguments
+    :param filename: String, name of the figure
+    :return: dict, the yearly_stats plotted (None if there is no data)
+    """
+    import matplotlib.pyplot as plt
+    import numpy as np
+    import seaborn
+
     seaborn.set()
-    data = dm.get_movie_data(filename, args)
-    data['year'] = data['publication_date'].apply(dm.get_year)
-    data['decade'] = data['year'].apply(get_decade)
-    decade_avg = data.groupby(
-        [args.category, 'decade']).agg(
-        {args.score: 'mean'})
-
-    categories = data[args.category].unique()
+    width = getattr(args, 'width', 10)
+    yearly = yearly_stats(data, args.category, args.score, width)
+    if yearly is None:
+        return None
+    mean = yearly['mean']
+
+    banded = yearly['count'].values >= MIN_BAND_MOVIES
+    lower = yearly['lower'].where(banded)
+    upper = yearly['upper'].where(banded)
+
     plt.figure(figsize=(16, 8))
-    for category in categories:
-        data = decade_avg.loc[category]
-        plt.plot(data.index, data.values, 'o-')
-    plt.legend(categories, prop={'size': 14})
-    plt.xlabel("Decades", fontsize=20)
+    bins = mean.index.values
+    lines = []
+    for column in mean.columns:
+        # connect the bins the person/genre has movies in
+        present = mean[column].notnull().values
+        line, = plt.plot(bins[present], mean[column].values[present], 'o-')
+        lines.append(line)
+        plt.fill_between(bins, lower[column].values, upper[column].values,
+                         color=line.get_color(), alpha=0.15)
+    plt.legend(lines, mean.columns, prop={'size': 14})
+    # the bands don't decide the scale: keep the averages readable
+    top, bottom = np.nanmax(mean.values), np.nanmin(mean.values)
+    margin = (top - bottom) / 10 or 1
+    plt.ylim(bottom - margin, top + margin)
+    plt.xlabel("Decades" if width == 10 else
+               "Years (by {})".format(width), fontsize=20)
     title_score = args.score.title().replace("_", " ")
     plt.ylabel("Average {}".format(title_score), fontsize=20)
     plt.title(
@@ -60,6 +162,27 @@ def main():
     )
     # plt.show()
     plt.savefig("figures/yearly-" + filename)
+    plt.close()
+    return yearly
+
+
+def main(args=None):
+    if args is None:
+        args = parser.parse_args()
+    import data.data as dm
+
+    def run():
+        data = dm.get_movie_data(args)
+        if args.no_plot:
+            yearly = yearly_stats(data, args.category, args.score, args.width)
+            if yearly is not None:
+                print(yearly['mean'])
+            return yearly
+        return plot_yearly(data, args, get_filename(args))
+
+    yearly = profiling.run(run, args.timings, args.profile, vars(args))
+    if args.csv and yearly is not None:
+        yearly['table'].to_csv(args.csv)
     print("Yearly Done")
 
 